@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+# ************************************************************#
+#  Label Generator for QBO                                   #
+#                                                            #
+#  Written by Yuri H. Galvao <yuri@galvao.ca>, January 2024  #
+# ************************************************************#
+
+import math
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from basic_functions import logging
+from deadlines import DeadlineExceeded
+
+# Declaring some variables
+base_memory = 300 * 2 ** 20  # In bytes (Python, Flask, pandas, openpyxl etc.)
+memory_per_conversion = 250 * 2 ** 20  # In bytes (one LibreOffice process plus the workbook)
+
+
+# Defining functions
+def read_first_line(path_to_file: str) -> str:
+    """
+    Reads the first line of a (system) file.
+
+    Arguments:
+        path_to_file (str): the path to the file.
+
+    Returns:
+        str: the first line of the file, or an empty string if the file cannot be read.
+    """
+
+    try:
+        with open(path_to_file, 'r') as file:
+            return file.readline().strip()
+    except OSError:
+        return ''
+
+
+def detect_cpus() -> float:
+    """
+    Detects how many CPUs the instance can use, taking the container's CPU quota (cgroups) into account.
+
+    Returns:
+        float: the quantity of CPUs.
+    """
+
+    try:
+        cpus = float(len(os.sched_getaffinity(0)))
+    except AttributeError:
+        cpus = float(os.cpu_count() or 1)
+
+    quota = read_first_line('/sys/fs/cgroup/cpu.max').split()  # cgroups v2, e.g. "200000 100000"
+    if len(quota) == 2 and quota[0] != 'max':
+        cpus = min(cpus, int(quota[0]) / int(quota[1]))
+    else:
+        quota, period = read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_quota_us'), \
+            read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_period_us')  # cgroups v1
+        if quota not in ('', '-1') and period not in ('', '0'):
+            cpus = min(cpus, int(quota) / int(period))
+
+    return cpus
+
+
+def detect_memory() -> int:
+    """
+    Detects how much memory the instance can use, taking the container's memory limit (cgroups) into account.
+
+    Returns:
+        int: the quantity of memory, in bytes.
+    """
+
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+    for path_to_file in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        limit = read_first_line(path_to_file)
+        if limit.isdigit():
+            memory = min(memory, int(limit))
+            break
+
+    return memory
+
+
+def get_capacity() -> int:
+    """
+    Computes how many label conversions the instance can run at once: one per CPU, limited by the memory available.
+    It can be overridden by the environment variable LABEL_MAX_CONVERSIONS.
+
+    Returns:
+        int: the quantity of concurrent conversions.
+    """
+
+    if os.environ.get('LABEL_MAX_CONVERSIONS'):
+        return max(1, int(os.environ['LABEL_MAX_CONVERSIONS']))
+
+    by_cpu = math.ceil(detect_cpus())
+    by_memory = (detect_memory() - base_memory) // memory_per_conversion
+
+    return max(1, min(by_cpu, by_memory))
+
+
+capacity = get_capacity()
+max_queue = int(os.environ.get('LABEL_MAX_QUEUE', capacity * 2))  # Labels that may wait for a free slot
+queue_timeout = float(os.environ.get('LABEL_QUEUE_TIMEOUT', 30))  # In seconds
+
+admission_condition = threading.Condition()
+admission_state = {
+    'in_flight': 0,
+    'borrowed': 0,  # Extra conversion slots taken by the chunks of the labels in progress (see "borrow_conversion_slots")
+    'queued': 0,
+    'admitted': 0,
+    'rejected': 0,
+    'average_seconds': 10.,  # Moving average of the time a label takes, used for the "Retry-After" header
+}
+
+## Free LibreOffice slots: each one has its own profile, since LibreOffice processes sharing a profile cannot run at once
+conversion_slots = queue.Queue()
+for slot in range(capacity):
+    conversion_slots.put(slot)
+
+logging.info(f'Admission control: {capacity} concurrent conversion(s), up to {max_queue} queued.')
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when the instance is too busy to take another label.
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__(f'Too many labels in progress; retry after {retry_after} s.')
+        self.retry_after = retry_after
+
+
+def get_retry_after() -> int:
+    """
+    Estimates how long (in seconds) a rejected client should wait before trying again.
+
+    Returns:
+        int: the quantity of seconds.
+    """
+
+    waves = (admission_state['queued'] + admission_state['in_flight'] + admission_state['borrowed']) / capacity
+    return max(1, math.ceil(waves * admission_state['average_seconds']))
+
+
+@contextmanager
+def admission() -> None:
+    """
+    Admits a label into the pipeline: runs it right away if there is a free conversion slot, waits in the queue
+    (up to "queue_timeout" seconds) if the queue is not full, or rejects it (raising "AdmissionRejected"). The slots
+    borrowed by the chunks of the labels in progress count as taken.
+    """
+
+    def has_free_slot() -> bool:
+        return admission_state['in_flight'] + admission_state['borrowed'] < capacity
+
+    with admission_condition:
+        if not has_free_slot():
+            if admission_state['queued'] >= max_queue:
+                admission_state['rejected'] += 1
+                raise AdmissionRejected(get_retry_after())
+
+            admission_state['queued'] += 1
+            try:
+                admitted = admission_condition.wait_for(has_free_slot, queue_timeout)
+            finally:
+                admission_state['queued'] -= 1
+
+            if not admitted:
+                admission_state['rejected'] += 1
+                raise AdmissionRejected(get_retry_after())
+
+        admission_state['in_flight'] += 1
+        admission_state['admitted'] += 1
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        with admission_condition:
+            admission_state['in_flight'] -= 1
+            seconds = time.perf_counter() - start
+            admission_state['average_seconds'] = .8 * admission_state['average_seconds'] + .2 * seconds
+            admission_condition.notify()
+
+
+@contextmanager
+def borrow_conversion_slots(wanted: int) -> int:
+    """
+    Borrows up to "wanted" conversion slots for the chunks of a label, besides the one that the label was admitted
+    with, taking only the slots that no other admitted label is owed. Until they are given back, the labels that
+    arrive wait in the admission queue (or are rejected), instead of waiting for a slot in the middle of their
+    conversion.
+
+    Arguments:
+        wanted (int): the quantity of extra slots wanted.
+
+    Returns:
+        int: the quantity of slots borrowed (0 if there is none to spare).
+    """
+
+    with admission_condition:
+        borrowed = max(0, min(wanted, capacity - admission_state['in_flight'] - admission_state['borrowed']))
+        admission_state['borrowed'] += borrowed
+
+    try:
+        yield borrowed
+    finally:
+        with admission_condition:
+            admission_state['borrowed'] -= borrowed
+            admission_condition.notify(borrowed)
+
+
+@contextmanager
+def conversion_slot(timeout: float = None) -> int:
+    """
+    Takes a free LibreOffice slot, so no more than "capacity" conversions run at once (including the chunks of the
+    labels that are converted in parallel), waiting up to "timeout" seconds for one.
+
+    Arguments:
+        timeout (float, optional): the maximum time to wait, in seconds. Default is None (no limit).
+
+    Returns:
+        int: the slot number (which identifies its LibreOffice profile).
+    """
+
+    try:
+        slot = conversion_slots.get(timeout=timeout)
+    except queue.Empty:
+        raise DeadlineExceeded('convert')
+
+    try:
+        yield slot
+    finally:
+        conversion_slots.put(slot)
+
+
+def get_admission_status() -> dict:
+    """
+    Reports the load of the label pipeline, so the autoscaler (or a person) can act before the instance is overloaded.
+
+    Returns:
+        dict: a dictionary containing the capacity, the labels in progress, the queue depth and the rejections.
+    """
+
+    with admission_condition:
+        return {
+            'capacity': capacity,
+            'max_queue': max_queue,
+            'in_flight': admission_state['in_flight'],
+            'borrowed_slots': admission_state['borrowed'],
+            'queue_depth': admission_state['queued'],
+            'admitted': admission_state['admitted'],
+            'rejected': admission_state['rejected'],
+            'average_seconds': round(admission_state['average_seconds'], 3),
+            'free_conversion_slots': conversion_slots.qsize(),
+        }
@@ -6,21 +6,128 @@
 #  Written by Yuri H. Galvao <yuri@galvao.ca>, January 2024  #
 # ************************************************************#
 
+import hashlib
+import io
 import os
 
-from flask import Flask, request, render_template, jsonify
+from flask import Flask, request, render_template, jsonify, send_file
 
-from label_generator import get_order_series
+from basic_functions import warm_up_on_start
+from deadlines import DeadlineExceeded, new_deadline
+from label_generator import get_order_series, realms
+from memory_monitor import check_admin_token, count_label, get_memory_status, start_memory_monitor
 
 # Instantiating Flask app object
 app = Flask(__name__)
 
+order_n = None  # Last fetched order number
+order_series = None  # Last fetched order data
+order_realm = None  # Realm (QBO company) of the last fetched order
+
+## Version of the page and of the invoice info it gets, part of the ETag of "/_show_invoice_info"
+template_version = hashlib.md5(open(os.path.join(app.root_path, 'templates', 'index.html'), 'rb').read()).hexdigest()[:8]
+invoice_infos = {}  # Invoice info already built, by ETag
+invoice_infos_max = 200  # Maximum quantity of entries in "invoice_infos"
+
+if warm_up_on_start:
+    from warm_up import warm_up
+
+    warm_up()  # Runs in background threads, so the app starts listening right away
+
+start_memory_monitor()
+
 
 # Defining functions - and decorating them
+def get_label_inputs(form: dict) -> dict:
+    """
+    Extracts the label inputs from the submitted form (the same fields are used for the label and its preview).
+
+    Arguments:
+        form (dict): the submitted form.
+
+    Returns:
+        dict: a dictionary containing the keyword arguments for "output_label" (except the order data).
+    """
+
+    try:
+        template = form['input_product_qty_check']
+    except:
+        template = ''
+
+    try:
+        products_sizes_names = form['product'].strip('"').replace(',', ', ')
+        products_sizes_names = [products_sizes_names] if len(products_sizes_names) < 98 else [
+            products_sizes_names[:97]]
+    except:
+        products_sizes_names = form['products'].strip('"').strip('||').split('||,')
+
+    return dict(
+        template=template,
+        selected_item=products_sizes_names,
+        add_job_info=form['add_info'],
+        package=form['package_type'],
+        packages_qty=int(form['packages_qty']),
+        qty_per_package=[int(n) for n in form['products_qty'].strip('"').split(',')],
+        to_address=form['to_address'],
+        additional_info_to='Attn.: ' + form['attn'] if form['attn'] not in ('', ' ', None) else ''
+    )
+
+
+def get_invoice_etag(realm: str, order_n_: int, order_series_: object) -> str:
+    """
+    Builds the ETag of the invoice info: it changes whenever the invoice is edited on QBO (its SyncToken is
+    incremented) or the page is updated.
+
+    Arguments:
+        realm (str): the realm ID.
+        order_n_ (int): the invoice number.
+        order_series_ (object): the invoice data (a Pandas Series).
+
+    Returns:
+        str: the ETag (without quotes).
+    """
+
+    sync_token = order_series_.get('SyncToken', '')
+    return f'{realm or "default"}-{order_n_}-{sync_token}-{template_version}'
+
+
+def get_invoice_info(etag: str, order_series_: object) -> dict:
+    """
+    Builds the invoice info shown to the user (destination address, products and attention), reusing the one
+    already built for the same ETag.
+
+    Arguments:
+        etag (str): the ETag of the invoice info (see "get_invoice_etag").
+        order_series_ (object): the invoice data (a Pandas Series).
+
+    Returns:
+        dict: a dictionary containing the destination address, products, and attention details.
+    """
+
+    from label_generator import get_address, get_products_names  # Lazy load, to prevent cold starts
+
+    invoice_info = invoice_infos.get(etag)
+    if invoice_info is None:
+        to_address = get_address(order_series_, 'to', 'no', '', '')
+        to_address = to_address[0] + '\n' + to_address[1] + '\n' + to_address[2]
+        products = get_products_names(order_series_)
+        d_name = order_series_.ShipMethodRef['name'] if order_series_.ShipMethodRef else ''
+        delivery_name = d_name if 'pickup' not in d_name.strip().lower() and 'pick up' not in d_name.strip().lower() else ''
+        invoice_info = dict(destination_address=to_address, products=products, attn=delivery_name)
+
+        if len(invoice_infos) >= invoice_infos_max:
+            invoice_infos.pop(next(iter(invoice_infos)), None)  # The oldest one
+
+        invoice_infos[etag] = invoice_info
+
+    return invoice_info
+
+
 @app.route('/_show_invoice_info')
 def show_invoice_info(error: bool = False):
     """
-    Retrieves invoice information and displays it to the user.
+    Retrieves invoice information and displays it to the user. The response carries an ETag, so the page can send
+    it back ("If-None-Match") and get an empty 304 response if the invoice did not change.
 
     Arguments:
         error (bool, optional): if True, displays an error message instead of the invoice information.
@@ -29,28 +136,84 @@ def show_invoice_info(error: bool = False):
         json: a JSON object containing the destination address, products, and attention details.
     """
 
-    from label_generator import get_address, get_products_names  # Lazy load, to prevent cold starts
-
     global order_n
     order_n = request.args.get('order_n', 0, type=int)
+    global order_realm
+    order_realm = request.args.get('realm', '')
     global order_series
-    order_series = get_order_series(order_n)
+    try:
+        order_series = get_order_series(order_n, order_realm, new_deadline(), fresh=True)  # Not the cached copy
+    except ValueError:  # Unknown realm
+        order_series = None
 
-    if order_series is not None:
-        to_address = get_address(order_series, 'to', 'no', '', '')
-        to_address = to_address[0] + '\n' + to_address[1] + '\n' + to_address[2]
-        products = get_products_names(order_series)
-        d_name = order_series.ShipMethodRef['name'] if order_series.ShipMethodRef else ''
-        delivery_name = d_name if 'pickup' not in d_name.strip().lower() and 'pick up' not in d_name.strip().lower() else ''
+    if order_series is None or error:
+        to_address = 'ORDER NOT FOUND! CHECK ORDER STATUS ON THE BACKEND SYSTEM OR TRY AGAIN!'
+        return jsonify(destination_address=to_address, products=[], attn='')
+
+    etag = get_invoice_etag(order_realm, order_n, order_series)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
     else:
-        error = True
+        response = jsonify(get_invoice_info(etag, order_series))
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-store'  # The page keeps its own cache (the browser's would hide the 304)
+
+    return response
 
-    if error:
-        to_address = 'ORDER NOT FOUND! CHECK ORDER STATUS ON THE BACKEND SYSTEM OR TRY AGAIN!'
-        products = []
-        delivery_name = ''
 
-    return jsonify(destination_address=to_address, products=products, attn=delivery_name)
+def make_label_from_form(form: dict) -> tuple:
+    """
+    Generates the label for the submitted form, fetching the order again if it is not the last fetched one. A label
+    that ran out of time is not tried again, since a second attempt could only overrun the deadline further.
+
+    Arguments:
+        form (dict): the submitted form.
+
+    Returns:
+        tuple: a tuple containing a status message and the link to the generated PDF file.
+    """
+
+    from label_generator import output_label, logging  # Lazy load, to prevent cold starts
+
+    global order_series
+    result = False
+    link = ''
+    realm = form.get('realm2', '')
+    deadline = new_deadline()  # For the whole label: fetching, rendering, converting and uploading
+
+    try:
+        order_n_ = int(form['order_n2'])
+        if order_n != order_n_ or order_realm != realm:
+            raise ValueError
+
+        result, link = output_label(
+            order_series=order_series,
+            order_n=order_n,
+            realm=realm,
+            deadline=deadline,
+            **get_label_inputs(form)
+        )
+    except DeadlineExceeded as e:
+        logging.critical(f'''The label could not be made in time! Exception: {repr(e)}''')
+    except Exception as e:
+        logging.error(f'''Error with the order number! Exception: {repr(e)}''')
+        logging.error('Trying again...')
+
+        try:
+            order_series = get_order_series(order_n_, realm, deadline, fresh=True)
+            result, link = output_label(
+                order_series=order_series,
+                order_n=order_n_,
+                realm=realm,
+                deadline=deadline,
+                **get_label_inputs(form)
+            )
+        except Exception as e:
+            logging.critical(f'''Error! Is there an already-fetched order? Exception: {e}''')
+            show_invoice_info(error=True)
+
+    return result, link
 
 
 @app.route('/', methods=['GET', 'POST'])
@@ -58,69 +221,108 @@ def index():
     """
     Handles the main route of the Flask application, processes form data, and calls the label generation function.
     After that, renders the HTML template for the main page, by using the Jinja2 engine, along with the result and 
-    a link to the generated PDF.
+    a link to the generated PDF. If the instance is too busy, answers with status 503 and a "Retry-After" header.
     """
 
     result = False
     link = ''
-    global order_n
-    global order_series
 
     if request.method == 'POST':
-        form = request.form
-        try:
-            template = form['input_product_qty_check']
-        except:
-            template = ''
+        from admission import AdmissionRejected, admission  # Lazy load, to prevent cold starts
 
         try:
-            products_sizes_names = form['product'].strip('"').replace(',', ', ')
-            products_sizes_names = [products_sizes_names] if len(products_sizes_names) < 98 else [
-                products_sizes_names[:97]]
-        except:
-            products_sizes_names = form['products'].strip('"').strip('||').split('||,')
+            with admission():
+                result, link = make_label_from_form(request.form)
+        except AdmissionRejected as e:
+            from label_generator import logging
 
-        try:
-            from label_generator import output_label, logging  # Lazy load, to prevent cold starts
-            order_n_ = int(form['order_n2'])
-            if order_n != order_n_:
-                raise ValueError
+            logging.warning(f'Label rejected! {e}')
+            page = render_template('index.html', result=False, link_to_pdf='', realms=realms, busy=e.retry_after)
+            return page, 503, {'Retry-After': str(e.retry_after)}
 
-            result, link = output_label(
-                template,
-                order_series,
-                order_n,
-                products_sizes_names,
-                form['add_info'],
-                form['package_type'],
-                int(form['packages_qty']),
-                [int(n) for n in form['products_qty'].strip('"').split(',')],
-                to_address=form['to_address'],
-                additional_info_to='Attn.: ' + form['attn'] if form['attn'] not in ('', ' ', None) else ''
-            )
-        except Exception as e:
-            logging.error(f'''Error with the order number! Exception: {repr(e)}''')
-            logging.error('Trying again...')
-
-            try:
-                order_series = get_order_series(order_n_)
-                result, link = output_label(
-                    template,
-                    order_series,
-                    order_n_,
-                    products_sizes_names,
-                    form['add_info'],
-                    form['package_type'],
-                    int(form['packages_qty']),
-                    [int(n) for n in form['products_qty'].strip('"').split(',')],
-                    to_address=form['to_address'],
-                    additional_info_to='Attn.: ' + form['attn'] if form['attn'] not in ('', ' ', None) else ''
-                )
-            except Exception as e:
-                logging.critical(f'''Error! Is there an already-fetched order? Exception: {e}''')
-                show_invoice_info(error=True)
-
-    return render_template('index.html', result=result, link_to_pdf=link)
+        count_label()  # May recycle the worker, once no other label is in progress
+
+    return render_template('index.html', result=result, link_to_pdf=link, realms=realms)
+
+
+@app.route('/_preview_label', methods=['POST'])
+def preview_label():
+    """
+    Draws a low-resolution PNG preview of the first page of the label, from the same fields as the main form,
+    so the user can check the label before generating the PDF.
+
+    Returns:
+        png: the image of the first page of the label, or an empty response with status 400 if the inputs are invalid.
+    """
+
+    from label_generator import logging  # Lazy load, to prevent cold starts
+    from label_preview import preview_label as draw_preview
+
+    form = request.form
+
+    try:
+        order_n_ = int(form['order_n2'])
+        realm = form.get('realm2', '')
+        label_inputs = get_label_inputs(form)
+        order_series_ = order_series if order_n == order_n_ and order_realm == realm else None
+        if order_series_ is None and label_inputs['to_address'] == '':
+            order_series_ = get_order_series(order_n_, realm, new_deadline())
+
+        png = draw_preview(order_series=order_series_, order_n=order_n_, **label_inputs)
+    except Exception as e:
+        logging.error(f'''Error when drawing the label preview! Exception: {repr(e)}''')
+        return '', 400
+
+    return send_file(io.BytesIO(png), mimetype='image/png', max_age=0)
+
+
+@app.route('/_warm_up')
+def warm_up_status():
+    """
+    Warms up every heavy resource (in background) and reports the readiness of each one. Meant to be used as the
+    startup probe: it answers with status 503 until everything is ready.
+
+    Returns:
+        json: a JSON object containing the readiness of each component.
+    """
+
+    from warm_up import warm_up  # Lazy load, to prevent cold starts
+
+    status = warm_up(retry_failed=request.args.get('retry', 0, type=int) == 1)
+
+    return jsonify(status), 200 if status['ready'] else 503
+
+
+@app.route('/_admission')
+def admission_status():
+    """
+    Reports the load of the label pipeline: the conversion capacity, the labels in progress and the queue depth.
+
+    Returns:
+        json: a JSON object containing the admission control status.
+    """
+
+    from admission import get_admission_status  # Lazy load, to prevent cold starts
+
+    return jsonify(get_admission_status())
+
+
+@app.route('/_memory')
+def memory_status():
+    """
+    Reports the memory used by the worker over time (RSS and, if enabled, the tracemalloc top-N) and the state of
+    the recycling policy. Add "?snapshot=1" to take a new sample right away. The request must carry the
+    MEMORY_ADMIN_TOKEN (in the "X-Admin-Token" header or in "?token="); if it is not set, the endpoint is disabled.
+
+    Returns:
+        json: a JSON object containing the memory status.
+    """
+
+    token = request.headers.get('X-Admin-Token') or request.args.get('token', '')
+    if not check_admin_token(token):
+        return jsonify(error='Forbidden'), 403
+
+    return jsonify(get_memory_status(snapshot=request.args.get('snapshot', 0, type=int) == 1))
 
 
 if __name__ == '__main__':
@@ -11,6 +11,7 @@ import json
 import logging
 import os
 import sys
+import threading
 import traceback
 
 # Declaring variables and instantiating objects
@@ -19,6 +20,8 @@ args = sys.argv[1:]  # List of arguments that were passed, if any
 on_premises = True if '--on-premises' in args else False  # If True, the script is running on a local machine
 yes_for_all = True if '--yes-for-all' in args else False
 sandbox = True if '--sandbox' in args else False  # If True, the script is running on Intuit's (QBO) sandbox environment
+# If True, the heavy resources are warmed up as soon as the app starts (see "warm_up.py")
+warm_up_on_start = True if '--warm-up' in args or os.environ.get('WARM_UP_ON_START') == '1' else False
 
 client = google.cloud.logging.Client() if not on_premises else None
 if client:
@@ -34,6 +37,9 @@ logging.basicConfig(
 console_handler = logging.StreamHandler(sys.stdout)
 logging.getLogger().addHandler(console_handler)
 
+in_flight_calls = {}  # Operations currently running, by key (see "single_flight")
+in_flight_lock = threading.Lock()
+
 
 # Defining functions
 def confirm(text: str) -> bool:
@@ -120,3 +126,45 @@ def list_from_input(text: str) -> list:
         final_list = [str(s) for s in raw_list.replace(' ', '').split(',')]
 
     return final_list
+
+
+def single_flight(key: tuple, function: object, *args, **kwargs) -> object:
+    """
+    Runs a function only once for concurrent callers that use the same key. The first caller runs it, while the
+    others wait for that call to finish and then share its result (or its exception).
+
+    Arguments:
+        key (tuple): a hashable key that identifies the operation (e.g. ('order', order_n)).
+        function (object): the callable to be run.
+        *args, **kwargs: the arguments to be passed to the callable.
+
+    Returns:
+        object: the value returned by the callable.
+    """
+
+    with in_flight_lock:
+        call = in_flight_calls.get(key)
+        leader = call is None
+        if leader:
+            call = {'done': threading.Event(), 'result': None, 'exception': None}
+            in_flight_calls[key] = call
+
+    if not leader:
+        logging.info(f'Waiting for the in-flight operation {key}...')
+        call['done'].wait()
+        if call['exception'] is not None:
+            raise call['exception']
+
+        return call['result']
+
+    try:
+        call['result'] = function(*args, **kwargs)
+    except BaseException as e:  # Also SystemExit, KeyboardInterrupt etc., so the waiters do not get None
+        call['exception'] = e
+        raise
+    finally:
+        with in_flight_lock:
+            del in_flight_calls[key]
+        call['done'].set()
+
+    return call['result']
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+# ************************************************************#
+#  Label Generator for QBO                                   #
+#                                                            #
+#  Written by Yuri H. Galvao <yuri@galvao.ca>, January 2024  #
+# ************************************************************#
+
+import os
+import signal
+import subprocess as subp
+import threading
+import time
+from contextlib import contextmanager
+
+from basic_functions import logging
+
+# Declaring some variables
+request_deadline = float(os.environ.get('LABEL_DEADLINE', 120))  # In seconds, for a whole request
+
+## Time budget of each stage of the label pipeline, in seconds (e.g. LABEL_STAGE_BUDGETS="convert=90,upload=20")
+stage_budgets = {'fetch': 20., 'render': 20., 'convert': 60., 'optimize': 15., 'upload': 30.}
+for budget in os.environ.get('LABEL_STAGE_BUDGETS', '').replace(' ', '').split(','):
+    if '=' in budget:
+        stage_budgets[budget.split('=')[0]] = float(budget.split('=')[1])
+
+stage_overruns = {name: 0 for name in stage_budgets}  # How many times each stage overran
+current_stage = threading.local()  # End of the stage that is running on each thread (see "with_stage_timeout")
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a stage of the label pipeline cannot start (or finish) before the deadline.
+    """
+
+    def __init__(self, stage: str):
+        super().__init__(f'The deadline was exceeded at the "{stage}" stage.')
+        self.stage = stage
+
+
+# Defining functions
+def new_deadline(seconds: float = None) -> float:
+    """
+    Sets the deadline for a request.
+
+    Arguments:
+        seconds (float, optional): the time the request may take. Default is "request_deadline".
+
+    Returns:
+        float: the deadline (a time.monotonic() value).
+    """
+
+    return time.monotonic() + (request_deadline if seconds is None else seconds)
+
+
+def record_overrun(stage_name: str, seconds: float) -> None:
+    """
+    Records (and logs) that a stage took longer than its budget or than the time left for the request.
+
+    Arguments:
+        stage_name (str): the name of the stage.
+        seconds (float): how long the stage took.
+    """
+
+    stage_overruns[stage_name] = stage_overruns.get(stage_name, 0) + 1
+    logging.critical(f'The "{stage_name}" stage overran: {seconds:.2f} s (budget: {stage_budgets[stage_name]} s).')
+
+
+def get_stage_timeout(deadline: float, stage_name: str) -> float:
+    """
+    Computes how long a stage may take: its own budget, limited by the time left until the deadline.
+
+    Arguments:
+        deadline (float): the deadline of the request, or None for no deadline.
+        stage_name (str): the name of the stage.
+
+    Returns:
+        float: the timeout of the stage, in seconds.
+    """
+
+    timeout = stage_budgets[stage_name]
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(stage_name)
+
+        timeout = min(timeout, remaining)
+
+    return timeout
+
+
+@contextmanager
+def stage(deadline: float, stage_name: str) -> float:
+    """
+    Runs a stage of the label pipeline within its time budget: raises "DeadlineExceeded" if there is no time left to
+    start it, exposes its timeout (also to the HTTP calls made through "with_stage_timeout") and records an overrun
+    if it takes longer than allowed.
+
+    Arguments:
+        deadline (float): the deadline of the request, or None for no deadline.
+        stage_name (str): the name of the stage.
+
+    Returns:
+        float: the timeout of the stage, in seconds.
+    """
+
+    timeout = get_stage_timeout(deadline, stage_name)
+    start = time.monotonic()
+    previous_end = getattr(current_stage, 'end', None)
+    current_stage.end = start + timeout
+
+    try:
+        yield timeout
+    finally:
+        current_stage.end = previous_end
+        seconds = time.monotonic() - start
+        if seconds > timeout:
+            record_overrun(stage_name, seconds)
+
+
+def with_stage_timeout(request: object, default_timeout: float = None) -> object:
+    """
+    Wraps the "request" method of an HTTP session (requests), so every call gets the time left for the current stage
+    as its timeout.
+
+    Arguments:
+        request (object): the "request" method of the session.
+        default_timeout (float, optional): the timeout of the calls made outside any stage (e.g. when warming up).
+            Default is None (no timeout).
+
+    Returns:
+        object: the wrapped method.
+    """
+
+    def request_with_timeout(*args, **kwargs):
+        end = getattr(current_stage, 'end', None)
+        if kwargs.get('timeout') is None:
+            if end is not None:
+                kwargs['timeout'] = max(.1, end - time.monotonic())
+            elif default_timeout is not None:
+                kwargs['timeout'] = default_timeout
+
+        return request(*args, **kwargs)
+
+    return request_with_timeout
+
+
+def run_process(cmd: list, timeout: float, stage_name: str) -> None:
+    """
+    Runs an external program, killing it (and every child process it started) if it exceeds the timeout.
+
+    Arguments:
+        cmd (list): the command and its arguments.
+        timeout (float): the timeout, in seconds.
+        stage_name (str): the name of the stage that runs the program.
+    """
+
+    p = subp.Popen(cmd, start_new_session=True)  # Own process group, so its children can be killed too
+    try:
+        p.wait(timeout=timeout)
+    except subp.TimeoutExpired:
+        os.killpg(p.pid, signal.SIGKILL)
+        p.wait()
+        raise DeadlineExceeded(stage_name)
+
+    if p.returncode != 0:
+        raise subp.CalledProcessError(p.returncode, cmd)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+
+# ************************************************************#
+#  Label Generator for QBO                                   #
+#                                                            #
+#  Written by Yuri H. Galvao <yuri@galvao.ca>, January 2024  #
+# ************************************************************#
+
+"""
+Local stand-in for an IPP printer (or a CUPS server), to check the direct printing without a real printer.
+
+It accepts the print jobs sent by CUPS' "lp" (Print-Job, or Create-Job followed by Send-Document for each file),
+answers the printer queries with a minimal set of attributes and keeps a record of the jobs and of their documents.
+It can also refuse the jobs ("--fail-jobs"), to exercise the failure path of the app.
+
+To point the app at the stand-in, set these environment variables (or flags) before starting it:
+
+    LABEL_PRINT_SERVER=localhost:8631
+    LABEL_PRINTER=Zebra  (any name is accepted)
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Declaring some variables
+parser = argparse.ArgumentParser(description='Stand-in for an IPP printer.')
+parser.add_argument('--port', type=int, default=8631)
+parser.add_argument('--fail-jobs', type=int, default=0, help='quantity of jobs to be refused (-1 refuses all of them)')
+parser.add_argument('--output', default='', help='directory where the printed documents are saved (empty: not saved)')
+
+## IPP operations, status codes and tags (RFC 8011)
+print_job, validate_job, create_job, send_document, get_jobs, get_printer_attributes = 0x02, 0x04, 0x05, 0x06, 0x0A, 0x0B
+successful_ok, client_error_not_found, server_error_not_accepting_jobs = 0x0000, 0x0406, 0x0506
+operation_group, job_group, end_of_attributes, printer_group = 0x01, 0x02, 0x03, 0x04
+integer_tag, boolean_tag, enum_tag = 0x21, 0x22, 0x23
+text_tag, name_tag, keyword_tag, uri_tag, charset_tag, language_tag, mime_tag = 0x41, 0x42, 0x44, 0x45, 0x47, 0x48, 0x49
+
+emulator_config = {'fail_jobs': 0, 'output': ''}
+jobs = []  # Jobs received, in order: id, printer, name, state and the MD5 of each document
+jobs_lock = threading.Lock()
+stats = {'jobs': 0, 'documents': 0, 'refused': 0}
+
+
+# Defining functions
+def parse_ipp_request(body: bytes) -> tuple:
+    """
+    Parses an IPP request.
+
+    Arguments:
+        body (bytes): the body of the HTTP request.
+
+    Returns:
+        tuple: the operation, the request ID, the attributes (a dictionary of lists of (tag, value) tuples, by name)
+        and the document data that follows the attributes.
+    """
+
+    operation, request_id = struct.unpack('>HI', body[2:8])
+    attributes = {}
+    name = ''
+    pos = 8
+    while pos < len(body):
+        tag = body[pos]
+        pos += 1
+        if tag == end_of_attributes:
+            break
+        elif tag < 0x10:  # Start of another attribute group
+            continue
+
+        name_length = struct.unpack('>H', body[pos:pos + 2])[0]
+        name = body[pos + 2:pos + 2 + name_length].decode() or name  # An empty name adds a value to the previous one
+        pos += 2 + name_length
+        value_length = struct.unpack('>H', body[pos:pos + 2])[0]
+        attributes.setdefault(name, []).append((tag, body[pos + 2:pos + 2 + value_length]))
+        pos += 2 + value_length
+
+    return operation, request_id, attributes, body[pos:]
+
+
+def get_value(attributes: dict, name: str, default: object = None) -> object:
+    """
+    Decodes the first value of an attribute of an IPP request.
+
+    Arguments:
+        attributes (dict): the attributes (see "parse_ipp_request").
+        name (str): the name of the attribute.
+        default (object, optional): the value returned if the attribute is missing. Default is None.
+
+    Returns:
+        object: the value (int for integers and enums, bool for booleans, str otherwise).
+    """
+
+    if name not in attributes:
+        return default
+
+    tag, value = attributes[name][0]
+    if tag in (integer_tag, enum_tag):
+        return struct.unpack('>i', value)[0]
+    elif tag == boolean_tag:
+        return value != b'\x00'
+
+    return value.decode(errors='replace')
+
+
+def encode_ipp_response(status: int, request_id: int, groups: list, message: str = '') -> bytes:
+    """
+    Builds an IPP response.
+
+    Arguments:
+        status (int): the IPP status code.
+        request_id (int): the request ID (the same of the request).
+        groups (list): the attribute groups after the operation attributes, as (group tag, attributes) tuples, where
+        the attributes are a list of (tag, name, value or list of values) tuples.
+        message (str, optional): the "status-message" attribute. Default is an empty string.
+
+    Returns:
+        bytes: the body of the HTTP response.
+    """
+
+    operation_attributes = [(charset_tag, 'attributes-charset', 'utf-8'),
+                            (language_tag, 'attributes-natural-language', 'en')]
+    if message:
+        operation_attributes.append((text_tag, 'status-message', message))
+
+    body = struct.pack('>BBHI', 1, 1, status, request_id)
+    for group_tag, attributes in [(operation_group, operation_attributes)] + groups:
+        body += bytes([group_tag])
+        for tag, name, values in attributes:
+            for n, value in enumerate(values if isinstance(values, list) else [values]):
+                if tag in (integer_tag, enum_tag):
+                    value = struct.pack('>i', value)
+                elif tag == boolean_tag:
+                    value = bytes([value])
+                else:
+                    value = value.encode()
+                name_ = name.encode() if n == 0 else b''
+                body += struct.pack('>BH', tag, len(name_)) + name_ + struct.pack('>H', len(value)) + value
+
+    return body + bytes([end_of_attributes])
+
+
+def get_job_group(job: dict, host: str) -> list:
+    """
+    Returns the attributes of a job, for the responses.
+
+    Arguments:
+        job (dict): the job.
+        host (str): the host (and port) of the stand-in, for the job URI.
+
+    Returns:
+        list: the job attributes group.
+    """
+
+    return [(job_group, [
+        (integer_tag, 'job-id', job['id']),
+        (uri_tag, 'job-uri', f'ipp://{host}/jobs/{job["id"]}'),
+        (enum_tag, 'job-state', 9 if job['state'] == 'completed' else 3),
+        (keyword_tag, 'job-state-reasons', 'job-completed-successfully' if job['state'] == 'completed' else 'none'),
+    ])]
+
+
+def get_printer_group(printer: str, host: str) -> list:
+    """
+    Returns the attributes of the printer, for the responses.
+
+    Arguments:
+        printer (str): the name of the printer (any name is accepted).
+        host (str): the host (and port) of the stand-in, for the printer URI.
+
+    Returns:
+        list: the printer attributes group.
+    """
+
+    return [(printer_group, [
+        (uri_tag, 'printer-uri-supported', f'ipp://{host}/printers/{printer}'),
+        (keyword_tag, 'uri-authentication-supported', 'none'),
+        (keyword_tag, 'uri-security-supported', 'none'),
+        (name_tag, 'printer-name', printer),
+        (enum_tag, 'printer-state', 3),  # Idle
+        (keyword_tag, 'printer-state-reasons', 'none'),
+        (boolean_tag, 'printer-is-accepting-jobs', emulator_config['fail_jobs'] == 0),
+        (mime_tag, 'document-format-supported', ['application/pdf', 'application/octet-stream']),
+        (enum_tag, 'operations-supported',
+         [print_job, validate_job, create_job, send_document, get_jobs, get_printer_attributes]),
+    ])]
+
+
+def save_document(job: dict, data: bytes) -> None:
+    """
+    Records a document of a job (and saves it, if an output directory is set).
+
+    Arguments:
+        job (dict): the job.
+        data (bytes): the document.
+    """
+
+    job['documents'].append(hashlib.md5(data).hexdigest())
+    stats['documents'] += 1
+    if emulator_config['output']:
+        os.makedirs(emulator_config['output'], exist_ok=True)
+        path_to_file = os.path.join(emulator_config['output'], f'job_{job["id"]}_{len(job["documents"])}.pdf')
+        open(path_to_file, 'wb').write(data)
+
+
+def handle_ipp_request(body: bytes, path: str, host: str) -> bytes:
+    """
+    Answers an IPP request: the print jobs are recorded (or refused, see "--fail-jobs") and every other operation
+    gets the printer attributes.
+
+    Arguments:
+        body (bytes): the body of the HTTP request.
+        path (str): the path of the HTTP request (e.g. "/printers/Zebra").
+        host (str): the host (and port) of the stand-in.
+
+    Returns:
+        bytes: the body of the HTTP response.
+    """
+
+    operation, request_id, attributes, data = parse_ipp_request(body)
+    printer_uri = get_value(attributes, 'printer-uri', '') or path
+    printer = printer_uri.rstrip('/').split('/')[-1] or 'default'
+
+    with jobs_lock:
+        if operation in (print_job, create_job):
+            if emulator_config['fail_jobs'] != 0:
+                emulator_config['fail_jobs'] -= emulator_config['fail_jobs'] > 0
+                stats['refused'] += 1
+                logging.info(f'Job refused on "{printer}".')
+                return encode_ipp_response(server_error_not_accepting_jobs, request_id, [],
+                                           'The printer is not accepting jobs.')
+
+            job = {'id': len(jobs) + 1, 'printer': printer, 'name': get_value(attributes, 'job-name', ''),
+                   'state': 'pending', 'documents': []}
+            jobs.append(job)
+            stats['jobs'] += 1
+            if operation == print_job:
+                save_document(job, data)
+                job['state'] = 'completed'
+
+            logging.info(f'Job {job["id"]} ("{job["name"]}") received on "{printer}".')
+            return encode_ipp_response(successful_ok, request_id, get_job_group(job, host))
+
+        if operation == send_document:
+            job_id = get_value(attributes, 'job-id') or int(get_value(attributes, 'job-uri', '0').split('/')[-1])
+            job = jobs[job_id - 1] if 0 < job_id <= len(jobs) else None
+            if job is None:
+                return encode_ipp_response(client_error_not_found, request_id, [], f'Job {job_id} not found.')
+
+            save_document(job, data)
+            if get_value(attributes, 'last-document', False):
+                job['state'] = 'completed'
+
+            return encode_ipp_response(successful_ok, request_id, get_job_group(job, host))
+
+    if operation == get_jobs:
+        return encode_ipp_response(successful_ok, request_id, [])
+
+    return encode_ipp_response(successful_ok, request_id, get_printer_group(printer, host))
+
+
+class IppHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler of the stand-in: IPP requests are POSTed (with "application/ipp"), and "/_jobs" reports the jobs.
+    """
+
+    protocol_version = 'HTTP/1.1'  # Keeps the connection open between the requests of "lp", as CUPS does
+
+    def read_body(self) -> bytes:
+        if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        body = b''
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            if size == 0:
+                while self.rfile.readline().strip():  # Trailers
+                    pass
+                return body
+
+            body += self.rfile.read(size)
+            self.rfile.readline()
+
+    def send_body(self, body: bytes, content_type: str) -> None:
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        host = self.headers.get('Host') or f'localhost:{self.server.server_address[1]}'
+        self.send_body(handle_ipp_request(self.read_body(), self.path, host), 'application/ipp')
+
+    def do_GET(self):
+        with jobs_lock:
+            body = json.dumps({'stats': stats, 'jobs': jobs} if self.path == '/_jobs' else stats)
+
+        self.send_body(body.encode(), 'application/json')
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def start_ipp_emulator(port: int = 0) -> ThreadingHTTPServer:
+    """
+    Starts the stand-in in a background thread (e.g. for a check run by another module).
+
+    Arguments:
+        port (int, optional): the TCP port. Default is 0 (any free port).
+
+    Returns:
+        ThreadingHTTPServer: the server ("server_address[1]" is the port; "shutdown()" stops it).
+    """
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), IppHandler)
+    threading.Thread(target=server.serve_forever, name='ipp_emulator', daemon=True).start()
+
+    return server
+
+
+if __name__ == '__main__':
+    options = parser.parse_args()
+    emulator_config.update(fail_jobs=options.fail_jobs, output=options.output)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    logging.info(f'IPP stand-in listening on port {options.port}.')
+    ThreadingHTTPServer(('127.0.0.1', options.port), IppHandler).serve_forever()
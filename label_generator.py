@@ -6,10 +6,15 @@
 #  Written by Yuri H. Galvao <yuri@galvao.ca>, January 2024  #
 # ************************************************************#
 
+import hashlib
+import io
 import pathlib
-import subprocess as subp
+import tempfile
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
+from functools import lru_cache
 from html import unescape
 
 import pandas as pd
@@ -21,7 +26,12 @@ from openpyxl.drawing.image import Image
 from quickbooks import QuickBooks
 from quickbooks.objects.invoice import Invoice
 
+from admission import borrow_conversion_slots, conversion_slot
 from basic_functions import *
+from deadlines import DeadlineExceeded, run_process, stage, stage_budgets, with_stage_timeout
+from pdf_optimizer import concatenate_pdfs, optimize_pdf, pdf_concatenation
+from print_spooler import direct_printing, spool_label
+from xlsx_filler import fill_workbook
 
 # Declaring some variables
 ## For Intuit
@@ -29,6 +39,45 @@ callback_uris = json.load(open('intuit_callback_uris.json', 'r'))
 intuit_keys = json.load(open('intuit_keys.json', 'r'))
 intuit_temp_keys = json.load(open('intuit_temp_keys.json', 'r'))
 
+default_realm = intuit_keys['company_id']
+## Realms (i.e. QBO companies) served by this instance: the default one plus the ones listed in "company_ids"
+realms = [default_realm] + [str(realm) for realm in intuit_keys.get('company_ids', []) if str(realm) != default_realm]
+qbo_requests_per_minute = intuit_keys.get('requests_per_minute', 500)  # Intuit's rate limit, per realm
+qbo_session_ttl = 50 * 60  # In seconds (Intuit's access tokens expire after 1 hour)
+invoice_cache_ttl = intuit_keys.get('invoice_cache_ttl', 60)  # In seconds (0 disables the cache)
+## Alternative QBO API and Intuit discovery document (e.g. the local emulator, see "qbo_emulator.py"). Empty means Intuit's.
+qbo_api_url = os.environ.get('QBO_API_URL', '').rstrip('/')
+intuit_discovery_url = os.environ.get('INTUIT_DISCOVERY_URL', '')
+if qbo_api_url.startswith('http://'):  # The emulator runs locally, without TLS
+    os.environ.setdefault('OAUTHLIB_INSECURE_TRANSPORT', '1')
+## Timeout of the calls to Intuit made outside any stage (e.g. when warming up), in seconds
+qbo_default_timeout = float(os.environ.get('QBO_DEFAULT_TIMEOUT', stage_budgets['fetch']))
+
+## Pooled QBO session, invoice cache and rate-limit budget of each realm
+realm_states = {
+    realm: {
+        'clients': None,
+        'created_at': 0.,
+        'session_lock': threading.Lock(),
+        'invoices': {},
+        'budget': float(qbo_requests_per_minute),
+        'budget_updated_at': time.monotonic(),
+        'budget_lock': threading.Lock(),
+    } for realm in realms
+}
+
+## For the rendering
+## Column widths of the label sheets; the cell sizes for cloud differ from the on-premises ones (see "make_label")
+label_column_widths = {
+    True: {'A': 3., 'B': 1.25, 'C': 25, 'D': 3.62, 'E': 27.85},  # On premises
+    False: {'A': 3.32, 'B': 1.25, 'C': 33.25, 'D': 6.75, 'E': 32.5},  # Cloud
+}
+label_chunk_size = int(os.environ.get('LABEL_CHUNK_SIZE', 10))  # Pages per chunk of the large labels (0 disables it)
+## If True, the labels are filled by the lightweight XML engine (see "xlsx_filler.py") instead of openpyxl
+xml_fill = True if '--xml-fill' in args or os.environ.get('LABEL_FILL_ENGINE') == 'xml' else False
+## LibreOffice profiles, one per conversion slot (see "admission.conversion_slot")
+libreoffice_profiles = os.environ.get('LIBREOFFICE_PROFILES', os.path.join(tempfile.gettempdir(), 'label_generator_lo'))
+
 ## For Google
 gcp_project = json.load(open('google-creds.json', 'r'))['project_id']
 
@@ -89,10 +138,22 @@ def get_tokens(auth_client: object) -> tuple:
     return
 
 
+class TimedAuthClient(AuthClient):
+    """
+    Intuit's "AuthClient" (a requests session) whose HTTP calls get the time left for the current stage as their
+    timeout, or "qbo_default_timeout" outside any stage. This also covers the discovery document fetched by the
+    constructor and the token refresh made by "QuickBooks", which would otherwise wait forever for a stalled server.
+    """
+
+    def request(self, *args, **kwargs):
+        return with_stage_timeout(super().request, qbo_default_timeout)(*args, **kwargs)
+
+
 def authenticate_on_intuit(
         sandbox: bool = sandbox,
         intuit_keys: dict = intuit_keys,
-        intuit_temp_keys: dict = intuit_temp_keys
+        intuit_temp_keys: dict = intuit_temp_keys,
+        realm: str = default_realm
 ) -> object:
     """
     Authenticates with QuickBooks Online via Intuit and initializes the QuickBooks client.
@@ -101,17 +162,18 @@ def authenticate_on_intuit(
         sandbox (bool): Specifies if the sandbox environment should be used.
         intuit_keys (dict): A dictionary containing Intuit's client ID and company ID.
         intuit_temp_keys (dict): A dictionary containing temporary keys for Intuit authentication.
+        realm (str): The realm ID (company ID) of the QuickBooks Online company.
 
     Returns:
         object: A tuple containing the authentication client and QuickBooks client objects.
     """
 
     uri = callback_uris['sandbox'] if sandbox else callback_uris['production']
-    auth_client = AuthClient(
+    auth_client = TimedAuthClient(
         client_id=intuit_keys['client_id'],
         client_secret=intuit_keys['client_secret'],
         redirect_uri=uri,
-        environment='sandbox' if sandbox else 'production',
+        environment=intuit_discovery_url or ('sandbox' if sandbox else 'production'),
         refresh_token=intuit_temp_keys['refresh_token'],
     )
 
@@ -119,25 +181,131 @@ def authenticate_on_intuit(
         client = QuickBooks(
             auth_client=auth_client,
             refresh_token=auth_client.refresh_token,
-            company_id=intuit_keys['company_id']
+            company_id=realm
         )
     except Exception as e:
         logging.warning(f'Authentication error! Try refreshing the tokens!\n\nException: {e}\n')
         logging.info('The program will now try to refresh the tokens.')
         try:
-            intuit_temp_keys = ask_for_data(get_tokens(auth_client), 'intuit_temp_keys', ask=False)
+            intuit_temp_keys = ask_for_data(get_tokens(auth_client), get_temp_keys_file(realm), ask=False)
             auth_client.refresh_token = intuit_temp_keys['refresh_token']
             client = QuickBooks(
                 auth_client=auth_client,
                 refresh_token=auth_client.refresh_token,
-                company_id=intuit_keys['company_id']
+                company_id=realm
             )
         except:
             raise e
 
+    if qbo_api_url:
+        client.api_url_v3 = client.sandbox_api_url_v3 = qbo_api_url
+
     return auth_client, client
 
 
+def get_realm(realm: str = None) -> str:
+    """
+    Validates the realm (i.e. the QBO company) chosen for a request.
+
+    Arguments:
+        realm (str, optional): the realm ID. If empty or None, the default realm is used.
+
+    Returns:
+        str: the realm ID.
+    """
+
+    if realm in ('', ' ', None):
+        return default_realm
+
+    realm = str(realm).strip()
+    if realm not in realm_states:
+        raise ValueError(f'Unknown realm: {realm}')
+
+    return realm
+
+
+def get_temp_keys_file(realm: str) -> str:
+    """
+    Returns the name (without the extension) of the file that stores the tokens of a realm.
+
+    Arguments:
+        realm (str): the realm ID.
+
+    Returns:
+        str: the file name, i.e. "intuit_temp_keys" for the default realm, "intuit_temp_keys_<realm>" for the others.
+    """
+
+    return 'intuit_temp_keys' if realm == default_realm else f'intuit_temp_keys_{realm}'
+
+
+def get_qbo_client(realm: str = None, renew: bool = False) -> tuple:
+    """
+    Returns the shared QBO session of a realm, authenticating on Intuit only when there is no session yet, when it
+    is about to expire or when a renewal is requested (e.g. after a failed call).
+
+    Arguments:
+        realm (str, optional): the realm ID. If None, the default realm is used.
+        renew (bool, optional): if True, authenticates again even if the current session is still valid.
+
+    Returns:
+        tuple: a tuple containing the authentication client and QuickBooks client objects.
+    """
+
+    realm = get_realm(realm)
+    state = realm_states[realm]
+
+    with state['session_lock']:
+        expired = time.monotonic() - state['created_at'] > qbo_session_ttl
+        if renew or expired or state['clients'] is None:
+            temp_keys_file = get_temp_keys_file(realm)
+            temp_keys = json.load(open(temp_keys_file + '.json', 'r'))
+            state['clients'] = authenticate_on_intuit(intuit_temp_keys=temp_keys, realm=realm)
+            state['created_at'] = time.monotonic()
+
+            auth_client, client = state['clients']
+            # The QBO calls get the time left for the stage (the ones to Intuit already do, see "TimedAuthClient")
+            client.session.request = with_stage_timeout(client.session.request, qbo_default_timeout)
+
+            if auth_client.refresh_token != temp_keys['refresh_token']:  # Intuit rotates the refresh tokens
+                ask_for_data(
+                    (('access_token', auth_client.access_token), ('refresh_token', auth_client.refresh_token)),
+                    temp_keys_file,
+                    ask=False
+                )
+
+        return state['clients']
+
+
+def take_qbo_budget(realm: str, end: float = None) -> None:
+    """
+    Takes one request from the rate-limit budget of a realm (a token bucket refilled at "qbo_requests_per_minute"),
+    waiting for the budget to be refilled if it is exhausted.
+
+    Arguments:
+        realm (str): the realm ID.
+        end (float, optional): the end of the "fetch" stage (see "deadlines.py"); "DeadlineExceeded" is raised if the
+        budget would only be refilled after it. Default is None (no limit).
+    """
+
+    state = realm_states[realm]
+    while True:
+        with state['budget_lock']:
+            now = time.monotonic()
+            refill = (now - state['budget_updated_at']) * qbo_requests_per_minute / 60
+            state['budget'] = min(float(qbo_requests_per_minute), state['budget'] + refill)
+            state['budget_updated_at'] = now
+            if state['budget'] >= 1:
+                state['budget'] -= 1
+                return
+
+            wait = (1 - state['budget']) * 60 / qbo_requests_per_minute
+            if end is not None and now + wait > end:
+                raise DeadlineExceeded('fetch')
+
+        logging.warning(f'Rate-limit budget of realm {realm} exhausted! Waiting {wait:.2f} s.')
+        time.sleep(wait)
+
+
 def get_ds_from_api(main_object: object) -> pd.Series:
     """
     Imports the data from all orders available in the designated API into a Pandas DataFrame.
@@ -166,12 +334,52 @@ def get_ds_from_api(main_object: object) -> pd.Series:
             return ds_ready
 
 
-def get_order_series(order_n: int) -> pd.Series:
+def get_order_series(order_n: int, realm: str = None, deadline: float = None, fresh: bool = False) -> pd.Series:
+    """
+    Fetches a specific invoice or order as a Pandas Series. Orders fetched in the last "invoice_cache_ttl" seconds
+    are served from the realm's cache (so they may miss the edits made on QBO meanwhile), unless "fresh" is True,
+    and concurrent calls for the same order number share a single fetch (see "fetch_order_series").
+
+    Arg.:
+        order_n (int): the invoice or order number to fetch.
+        realm (str, optional): the realm ID. If None, the default realm is used.
+        deadline (float, optional): the deadline of the request (see "deadlines.py"). Default is None.
+        fresh (bool, optional): if True, the order is always fetched from QBO (e.g. when the user asks for it), and
+        the cache is updated. Default is False.
+
+    Returns:
+        pd.Series: a Pandas Series containing the order data, or None if the function fails to fetch the data.
+    """
+
+    realm = get_realm(realm)
+    invoices = realm_states[realm]['invoices']
+
+    cached = invoices.get(str(order_n))
+    if not fresh and cached is not None and time.monotonic() - cached[0] < invoice_cache_ttl:
+        return cached[1]
+
+    ds = single_flight(('order', realm, str(order_n)), fetch_order_series, order_n, realm, deadline)
+
+    if ds is not None and invoice_cache_ttl > 0:
+        now = time.monotonic()
+        for cached_order_n, (fetched_at, _) in list(invoices.items()):
+            if now - fetched_at >= invoice_cache_ttl:
+                invoices.pop(cached_order_n, None)
+
+        invoices[str(order_n)] = (now, ds)
+
+    return ds
+
+
+def fetch_order_series(order_n: int, realm: str = None, deadline: float = None) -> pd.Series:
     """
     Fetches a specific invoice or order as a Pandas Series from an API, retrying up to 3 times if an exception occurs.
+    Each attempt runs within the "fetch" stage budget, and no attempt starts after the deadline.
 
     Arg.:
         order_n (int): the invoice or order number to fetch.
+        realm (str, optional): the realm ID. If None, the default realm is used.
+        deadline (float, optional): the deadline of the request (see "deadlines.py"). Default is None.
 
     Returns:
         pd.Series: a Pandas Series containing the order data, or None if the function fails to fetch the data after 3 attempts.
@@ -179,19 +387,24 @@ def get_order_series(order_n: int) -> pd.Series:
 
     ds = None
     i = 0
-    auth_client, client = authenticate_on_intuit()
     while ds is None and i < 3:
-        try:
-            main_object = Invoice.choose([str(order_n)], field='DocNumber', qb=client)[0]
-            ds = get_ds_from_api(main_object)
-        except Exception as e:
-            logging.error('''Error when fetching data from the designated API! Trying again in half second.''')
-            logging.critical(f'''Exception: {repr(e)}''')
-            ds = None
-            time.sleep(.5)
-            i += 1
-        else:
-            return ds
+        with stage(deadline, 'fetch') as timeout:
+            end = time.monotonic() + timeout
+            try:
+                auth_client, client = get_qbo_client(realm, renew=i > 0)
+                take_qbo_budget(get_realm(realm), end)
+                main_object = Invoice.choose([str(order_n)], field='DocNumber', qb=client)[0]
+                ds = get_ds_from_api(main_object)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                logging.error('''Error when fetching data from the designated API! Trying again in half second.''')
+                logging.critical(f'''Exception: {repr(e)}''')
+                ds = None
+                time.sleep(.5)
+                i += 1
+            else:
+                return ds
 
 
 def get_products_names(order_series: pd.Series) -> list:
@@ -395,6 +608,135 @@ def get_job_details(
     return job_details['order_n'], '', job_details['additional_job_info'], job_details['package']
 
 
+def get_label_data(
+        order_series: pd.Series,
+        selected_item: list,
+        order_n: int,
+        add_job_info: str,
+        package: str,
+        packages_qty: int,
+        qty_per_package: list,
+        from_address: str,
+        to_address: str,
+        additional_info_from: str,
+        additional_info_to: str
+) -> tuple:
+    """
+    Gathers the addresses, job details and selected item(s) that go on the label, based on the user's inputs and
+    the order data.
+
+    Arguments:
+        See "make_label".
+
+    Returns:
+        tuple: containing the 'from' address (or None), the 'to' address, the job details and the selected item(s).
+    """
+
+    from_address = get_address(
+        order_series,
+        'from',
+        'no' if from_address in ('', ' ', None, []) else 'yes',
+        from_address,
+        additional_info_from
+    )
+
+    if to_address != '':
+        to_address = get_address(
+            order_series,
+            'to',
+            'yes',
+            to_address,
+            additional_info_to
+        )
+    else:
+        to_address = get_address(
+            order_series,
+            'to',
+            'no',
+            to_address,
+            additional_info_to
+        )
+
+    job_details = get_job_details(
+        order_series,
+        order_n,
+        add_job_info,
+        package,
+        packages_qty,
+        qty_per_package
+    )
+
+    selected_item = select_product(order_n,
+                                   get_products_names(order_series)) if selected_item is None else selected_item
+
+    return from_address, to_address, job_details, selected_item
+
+
+def get_label_cells(
+        template: str,
+        selected_item: list,
+        from_address: tuple,
+        to_address: tuple,
+        job_details: tuple,
+        n: int,
+        checked_items: int
+) -> dict:
+    """
+    Computes the values to be written into the label cells for a given package (i.e. page) of the label.
+
+    Arguments:
+        template (str): the template number to be used for the label.
+        selected_item (list): the selected item(s).
+        from_address (tuple): the 'from' address lines, or None to keep the template's address.
+        to_address (tuple): the 'to' address lines.
+        job_details (tuple): the job details, as returned by "get_job_details".
+        n (int): the index of the package (0 for the first one).
+        checked_items (int): the quantity of items whose quantities are informed for each package (template 2).
+
+    Returns:
+        dict: a dictionary with the cell coordinates (e.g. 'C5') as keys and the cell values as values.
+    """
+
+    label_cells = {}
+
+    if from_address is not None:
+        label_cells['C1'], label_cells['C2'], label_cells['C3'], label_cells['C4'] = from_address
+
+    label_cells['C5'], label_cells['C6'], label_cells['C7'], label_cells['C8'] = to_address
+    label_cells['C9'], label_cells['C10'], label_cells['C12'], package_data = job_details
+
+    try:
+        label_cells['C11'] = selected_item[n]
+    except:
+        label_cells['C11'] = selected_item[0]
+
+    label_cells['E8'] = f'{package_data[0]} {n + 1} of {package_data[1]}  '
+
+    if template in ('', ' ', '1', None):
+        try:
+            label_cells['D11'] = f'Total qty: {sum(package_data[2])}  '
+        except:
+            label_cells['D11'] = f'Total qty: {package_data[2]}  '
+
+        try:
+            label_cells['D12'] = f'Qty in this {package_data[0].lower()}: {package_data[2][n]}  '
+        except:
+            label_cells['D12'] = f'Qty in this {package_data[0].lower()}: {package_data[2]}  '
+    else:
+        label_cells['E10'] = f'Qty in this {package_data[0].lower()}:'
+
+        try:
+            qties_info = ''
+            for i, qty in enumerate(package_data[2][n * checked_items:(n + 1) * checked_items]):
+                qties_info += f'Item {i + 1}: {qty}\n'
+
+            label_cells['E11'] = qties_info
+        except Exception as e:
+            label_cells['E11'] = f'Item 1: {package_data[2]}'
+
+    return label_cells
+
+
 def make_label(
         template: str,
         order_series: pd.Series,
@@ -410,6 +752,9 @@ def make_label(
         additional_info_from: str,
         additional_info_to: str,
         on_premises: bool = on_premises,
+        realm: str = None,
+        deadline: float = None,
+        pages: range = None
 ) -> tuple:
     """
     Creates the shipping label using the provided workbook (Excel file) and user inputs.
@@ -430,140 +775,176 @@ def make_label(
         additional_info_to (str): additional information for the 'to' address.
         on_premises (bool, optional): if True, uses the on-premises template. The reason is
         because cell sizes for cloud may differ (I don't know why). Default is False.
+        realm (str, optional): the realm ID (QBO company) of the order. Default is None (the default realm).
+        deadline (float, optional): the time (see "time.monotonic") by which every page must be filled, i.e. the end
+        of the "render" stage (see "deadlines.py"). Default is None.
+        pages (range, optional): the pages (i.e. packages) to be rendered, for a chunk of the label. Default is None
+        (all of them).
 
     Returns:
         tuple: containing the modified workbook object, a status message, and the order number.
     """
 
     if order_series is None:
-        order_series = get_order_series(order_n)
-
-    order_df_row = order_series
+        order_series = get_order_series(order_n, realm, deadline)
 
     wb = spreadsheet
 
-    from_address = get_address(
-        order_df_row,
-        'from',
-        'no' if from_address in ('', ' ', None, []) else 'yes',
+    label_pages, order_number = get_label_pages(
+        template,
+        order_series,
+        selected_item,
+        order_n,
+        add_job_info,
+        package,
+        packages_qty,
+        qty_per_package,
         from_address,
-        additional_info_from
+        to_address,
+        additional_info_from,
+        additional_info_to,
+        pages
     )
 
-    if to_address != '':
-        to_address = get_address(
-            order_df_row,
-            'to',
-            'yes',
-            to_address,
-            additional_info_to
-        )
-    else:
-        to_address = get_address(
-            order_df_row,
-            'to',
-            'no',
-            to_address,
-            additional_info_to
-        )
+    for i, label_cells in enumerate(label_pages):
+        if deadline is not None and time.monotonic() > deadline:
+            raise DeadlineExceeded('render')
 
-    job_details = get_job_details(
-        order_df_row,
+        if i != 0:
+            wb.copy_worksheet(ws)
+
+        ws = wb.worksheets[i]
+        set_label_layout(ws, on_premises)
+
+        if i != 0:  # The first sheet keeps the template's logo
+            logo = Image('logo_for_xlsx.png')
+            ws.add_image(logo, 'E1')
+
+        for cell, value in label_cells.items():
+            ws[cell] = value
+
+    return wb, 'Finished', order_number
+
+
+def get_label_pages(
+        template: str,
+        order_series: pd.Series,
+        selected_item: list,
+        order_n: int,
+        add_job_info: str,
+        package: str,
+        packages_qty: int,
+        qty_per_package: list,
+        from_address: str,
+        to_address: str,
+        additional_info_from: str,
+        additional_info_to: str,
+        pages: range = None
+) -> tuple:
+    """
+    Computes the cell values of every page (i.e. package) of the label.
+
+    Arguments:
+        See "make_label".
+
+    Returns:
+        tuple: containing a list with the cell values of each page (see "get_label_cells") and the order number.
+    """
+
+    from_address, to_address, job_details, selected_item = get_label_data(
+        order_series,
+        selected_item,
         order_n,
         add_job_info,
         package,
         packages_qty,
-        qty_per_package
+        qty_per_package,
+        from_address,
+        to_address,
+        additional_info_from,
+        additional_info_to
     )
 
-    selected_item = select_product(order_n,
-                                   get_products_names(order_series)) if selected_item is None else selected_item
-
     qty_of_qties = len(qty_per_package)
     checked_items = int(qty_of_qties / packages_qty)
 
-    for n in range(job_details[3][1]):
-        if n != 0:
-            wb.copy_worksheet(ws)
+    pages = range(job_details[3][1]) if pages is None else pages
+    label_pages = [
+        get_label_cells(template, selected_item, from_address, to_address, job_details, n, checked_items)
+        for n in pages
+    ]
 
-        ws = wb.worksheets[n]
-        ws.page_margins.left = 0.
-        ws.page_margins.right = 0.
-        ws.page_margins.top = 0.
-        ws.page_margins.bottom = 0.
-        ws.column_dimensions['B'].width = 1.25
-        if on_premises:
-            ws.column_dimensions['A'].width = 3.
-            ws.column_dimensions['C'].width = 25
-            ws.column_dimensions['D'].width = 3.62
-            ws.column_dimensions['E'].width = 27.85
-        else:
-            ws.column_dimensions['A'].width = 3.32  # 2.75
-            ws.column_dimensions['C'].width = 33.25  # 32. #28.89
-            ws.column_dimensions['D'].width = 6.75  # 37.5 #27.5
-            ws.column_dimensions['E'].width = 32.5
-
-        ws.sheet_properties.outlinePr.applyStyles = True
-        ws.sheet_properties.pageSetUpPr.fitToPage = False
-        ws.delete_cols(6, 4)
-        ws.print_area = 'A1:E12'
-        ws.set_printer_settings(0, orientation='landscape')
-        ws.page_setup.paperHeight = '152mm'
-        ws.page_setup.paperWidth = '102mm'
-
-        if n != 0:
-            logo = Image('logo_for_xlsx.png')
-            ws.add_image(logo, 'E1')
+    return label_pages, job_details[0].split(' ')[-1]
 
-        if from_address is not None:
-            ws['C1'], ws['C2'], ws['C3'], ws['C4'] = from_address
 
-        ws['C5'], ws['C6'], ws['C7'], ws['C8'] = to_address
-        ws['C9'], ws['C10'], ws['C12'], package_data = job_details
+def set_label_layout(ws: object, on_premises: bool = on_premises) -> None:
+    """
+    Sets the page layout of a label sheet: no margins, the column widths, the print area and the 4x6 paper.
 
-        if template in ('', ' ', '1', None):
-            try:
-                ws['C11'] = selected_item[n]
-            except:
-                ws['C11'] = selected_item[0]
+    Arguments:
+        ws (object): the openpyxl worksheet object.
+        on_premises (bool, optional): if True, uses the on-premises column widths (see "make_label").
+    """
 
-            ws['E8'] = f'{package_data[0]} {n + 1} of {package_data[1]}  '
+    ws.page_margins.left = 0.
+    ws.page_margins.right = 0.
+    ws.page_margins.top = 0.
+    ws.page_margins.bottom = 0.
+    for column, width in label_column_widths[bool(on_premises)].items():
+        ws.column_dimensions[column].width = width
 
-            try:
-                ws['D11'] = f'Total qty: {sum(package_data[2])}  '
-            except:
-                ws['D11'] = f'Total qty: {package_data[2]}  '
+    ws.sheet_properties.outlinePr.applyStyles = True
+    ws.sheet_properties.pageSetUpPr.fitToPage = False
+    ws.delete_cols(6, 4)
+    ws.print_area = 'A1:E12'
+    ws.set_printer_settings(0, orientation='landscape')
+    ws.page_setup.paperHeight = '152mm'
+    ws.page_setup.paperWidth = '102mm'
 
-            try:
-                ws['D12'] = f'Qty in this {package_data[0].lower()}: {package_data[2][n]}  '
-            except:
-                ws['D12'] = f'Qty in this {package_data[0].lower()}: {package_data[2]}  '
-        else:
-            try:
-                ws['C11'] = selected_item[n]
-            except:
-                ws['C11'] = selected_item[0]
 
-            ws['E8'] = f'{package_data[0]} {n + 1} of {package_data[1]}  '
+@lru_cache(maxsize=None)
+def get_bucket(bucket_name: str) -> object:
+    """
+    Returns (creating them only once) the Google Cloud Storage client and the bucket object.
 
-            ws['E10'] = f'Qty in this {package_data[0].lower()}:'
+    Arguments:
+        bucket_name (str): the name of the Google Cloud Storage bucket.
 
-            try:
-                qties_info = ''
-                for i, n in enumerate(package_data[2]):
-                    if i < checked_items:
-                        qties_info += f'Item {i + 1}: {n}\n'
-
-                ws['E11'] = qties_info
-                qties_info = ''
-                package_data[2] = package_data[2][checked_items:]
-            except Exception as e:
-                ws['E11'] = f'Item 1: {package_data[2]}'
+    Returns:
+        object: the bucket object.
+    """
 
-    return wb, 'Finished', job_details[0].split(' ')[-1]
+    # Explicitly use service account credentials by specifying the private key file.
+    storage_client = storage.Client.from_service_account_json('google-creds.json')
+
+    return storage_client.get_bucket(bucket_name)
+
+
+@lru_cache(maxsize=None)
+def get_template_bytes(template: str) -> bytes:
+    """
+    Reads (only once per template) the label template file (.xlsx).
 
+    Arguments:
+        template (str): the template number to be used for the label.
 
-def upload_to_bucket(blob_name: str, path_to_file: str, bucket_name: str) -> str:
+    Returns:
+        bytes: the content of the template file.
+    """
+
+    local_path = pathlib.Path().resolve().__str__()  # Gets the local path
+
+    try:
+        return open(f'./templates/template{template}.xlsx', 'rb').read()
+    except FileNotFoundError:
+        try:
+            return open(local_path + f'\\templates\\template{template}.xlsx', 'rb').read()
+        except Exception as e:
+            logging.error(f'''Path error! Check your path to "template{template}.xlsx".''')
+            raise e
+
+
+def upload_to_bucket(blob_name: str, path_to_file: str, bucket_name: str, timeout: float = 60) -> str:
     """
     Uploads a file to a specified Google Cloud Storage bucket.
 
@@ -571,18 +952,15 @@ def upload_to_bucket(blob_name: str, path_to_file: str, bucket_name: str) -> str
         blob_name (str): the name to be used for the blob (file) in the bucket.
         path_to_file (str): the local file path of the file to be uploaded.
         bucket_name (str): the name of the Google Cloud Storage bucket to upload the file to.
+        timeout (float, optional): the timeout of the upload, in seconds. Default is 60.
 
     Returns:
         str: a public URL to access the uploaded file in the Google Cloud Storage bucket.
     """
 
-    # Explicitly use service account credentials by specifying the private key file.
-    storage_client = storage.Client.from_service_account_json('google-creds.json')
-
-    # print(buckets = list(storage_client.list_buckets())
-    bucket = storage_client.get_bucket(bucket_name)
+    bucket = get_bucket(bucket_name)
     blob = bucket.blob(blob_name)
-    blob.upload_from_filename(path_to_file)
+    blob.upload_from_filename(path_to_file, timeout=timeout)
 
     os.remove(path_to_file)
 
@@ -590,38 +968,115 @@ def upload_to_bucket(blob_name: str, path_to_file: str, bucket_name: str) -> str
     return blob.public_url
 
 
-def generate_pdf(file_name: str) -> None:
+def get_libreoffice_cmd(path_to_file: str, output_dir: str, slot: int) -> list:
     """
-    Converts the Excel file (.xlsx) into a PDF file and uploads it to a specified Google Cloud Storage bucket.
+    Builds the command that converts an Excel file (.xlsx) into a PDF file, using the LibreOffice profile of a
+    conversion slot.
+
+    Arguments:
+        path_to_file (str): the path to the Excel file.
+        output_dir (str): the directory where the PDF file is saved.
+        slot (int): the conversion slot (see "admission.conversion_slot").
+
+    Returns:
+        list: the command and its arguments.
+    """
+
+    profile = pathlib.Path(libreoffice_profiles, str(slot)).resolve().as_uri()
+
+    return ['libreoffice', f'-env:UserInstallation={profile}', '--headless', '--convert-to', 'pdf', '--outdir',
+            output_dir, path_to_file]
+
+
+def convert_to_pdf(file_name: str, deadline: float = None) -> str:
+    """
+    Converts the Excel file (.xlsx) into a PDF file, within the time budget of the conversion (see "deadlines.py").
+    LibreOffice is killed if it hangs, and the Excel file is removed in any case.
 
     Arguments:
         file_name (str): the name of the Excel file to be converted.
+        deadline (float, optional): the deadline of the request (see "deadlines.py"). Default is None.
 
     Returns:
-        str: the public URL to access the generated PDF file in the Google Cloud Storage bucket.
+        str: the local file path of the PDF file.
     """
 
-    cmd = f'libreoffice --headless --convert-to pdf --outdir ./output {file_name}'
+    path_to_pdf = './output/' + file_name[:-5] + '.pdf'
 
     try:
-        p = subp.run(cmd, shell=True)
+        with stage(deadline, 'convert') as timeout:
+            start = time.monotonic()
+            with conversion_slot(timeout) as slot:
+                run_process(get_libreoffice_cmd(file_name, './output', slot),
+                            timeout - (time.monotonic() - start), 'convert')
     # convert_to_pdf = UnoConverter()
     # convert_to_pdf.convert(inpath=file_name, outpath='print_this.pdf', convert_to='pdf')
     except Exception as e:
         logging.error(e)
-    else:
-        file_name_pdf = file_name[:-5] + '.pdf'
+        if os.path.isfile(path_to_pdf):
+            os.remove(path_to_pdf)
+        raise e
     finally:
         os.remove(file_name)
 
-    url_to_pdf = upload_to_bucket(file_name_pdf, './output/' + file_name_pdf, f'{gcp_project}-processed-labels')
+    return path_to_pdf
+
 
-    logging.info(f'PDF created!\n')
+def publish_pdf(path_to_pdf: str, deadline: float = None) -> str:
+    """
+    Optimizes the PDF file and uploads it to a specified Google Cloud Storage bucket. When running on premises with
+    a printer configured, the PDF file is sent straight to the printer instead. The optimization and the upload run
+    within their time budgets (see "deadlines.py"), and the PDF file is removed if any of them fails.
+
+    Arguments:
+        path_to_pdf (str): the local file path of the PDF file.
+        deadline (float, optional): the deadline of the request (see "deadlines.py"). Default is None.
+
+    Returns:
+        str: the public URL to access the PDF file in the Google Cloud Storage bucket (empty if printed).
+    """
+
+    file_name_pdf = os.path.basename(path_to_pdf)
+
+    try:
+        with stage(deadline, 'optimize'):
+            optimize_pdf(path_to_pdf)
+
+        if direct_printing:
+            spool_label(path_to_pdf)
+            logging.info('PDF created and sent to the printer!\n')
+
+            return ''
+
+        with stage(deadline, 'upload') as timeout:
+            url_to_pdf = upload_to_bucket(file_name_pdf, path_to_pdf, f'{gcp_project}-processed-labels', timeout)
+    except Exception as e:
+        if os.path.isfile(path_to_pdf):
+            os.remove(path_to_pdf)
+        raise e
+
+    logging.info('PDF created!\n')
     logging.info(f'Download it here: {url_to_pdf}')
 
     return url_to_pdf
 
 
+def generate_pdf(file_name: str, deadline: float = None) -> str:
+    """
+    Converts the Excel file (.xlsx) into a PDF file and uploads it to a specified Google Cloud Storage bucket (or
+    sends it to the printer). See "convert_to_pdf" and "publish_pdf".
+
+    Arguments:
+        file_name (str): the name of the Excel file to be converted.
+        deadline (float, optional): the deadline of the request (see "deadlines.py"). Default is None.
+
+    Returns:
+        str: the public URL to access the generated PDF file in the Google Cloud Storage bucket (empty if printed).
+    """
+
+    return publish_pdf(convert_to_pdf(file_name, deadline), deadline)
+
+
 def output_label(
         template: str = '',
         order_series: pd.Series = None,
@@ -634,7 +1089,9 @@ def output_label(
         from_address: str = [],
         to_address: str = [],
         additional_info_from: str = None,
-        additional_info_to: str = None
+        additional_info_to: str = None,
+        realm: str = None,
+        deadline: float = None
 ) -> tuple:
     """
     Generates a shipping label based on the given inputs and saves it as an Excel file (.xlsx). Then, converts the Excel file into a PDF file, and uploads it to a Google Cloud Storage bucket.
@@ -652,31 +1109,17 @@ def output_label(
         to_address (str, optional): the 'to' address to be printed on the label. Default is an empty list.
         additional_info_from (str, optional): additional information for the 'from' address. Default is None.
         additional_info_to (str, optional): additional information for the 'to' address. Default is None.
+        realm (str, optional): the realm ID (QBO company) of the order. Default is None (the default realm).
+        deadline (float, optional): the deadline of the request (see "deadlines.py"). Default is None.
 
     Returns:
         tuple: a tuple containing a status message ('Success') and the public URL to access the generated PDF file in the Google Cloud Storage bucket.
     """
 
-    local_path = pathlib.Path().resolve().__str__()  # Gets the local path
-
-    try:
-        wb = load_workbook(f'./templates/template{template}.xlsx')
-    except FileNotFoundError:
-        try:
-            wb = load_workbook(local_path + f'\\templates\\template{template}.xlsx')
-        except Exception as e:
-            logging.error(f'''Path error! Check your path to "template{template}.xlsx".''')
-            logging.critical(f'''Exception: {e}''')
-    except Exception as e:
-        logging.error('''Unknown error!''')
-        logging.critical(f'''Exception: {e}''')
-
-    wb, status, order_n = make_label(
+    label_inputs = (
         template,
-        order_series,
-        selected_item,
-        wb,
         order_n,
+        selected_item,
         add_job_info,
         package,
         packages_qty,
@@ -684,21 +1127,181 @@ def output_label(
         from_address,
         to_address,
         additional_info_from,
-        additional_info_to
+        additional_info_to,
+        get_realm(realm)
     )
+    label_hash = hashlib.sha256(repr(label_inputs).encode()).hexdigest()
+
+    # Concurrent submissions of the very same label share a single render (and a single PDF conversion)
+    return single_flight(('label', label_hash), render_label, order_series, deadline, *label_inputs)
+
+
+def render_label(
+        order_series: pd.Series,
+        deadline: float,
+        template: str,
+        order_n: int,
+        selected_item: list,
+        add_job_info: str,
+        package: str,
+        packages_qty: int,
+        qty_per_package: list,
+        from_address: str,
+        to_address: str,
+        additional_info_from: str,
+        additional_info_to: str,
+        realm: str
+) -> tuple:
+    """
+    Fills the template with the label data, saves it as an Excel file (.xlsx) and converts it into a PDF file.
+    Labels with more than "label_chunk_size" pages are rendered and converted in chunks, in parallel as far as there
+    are conversion slots to spare (see "admission.borrow_conversion_slots"), otherwise one after another, and the PDF
+    files of the chunks are concatenated in order.
+    See "output_label" for the arguments.
+
+    Returns:
+        tuple: a tuple containing a status message ('Success') and the public URL to access the generated PDF file.
+    """
+
+    label_inputs = (template, order_n, selected_item, add_job_info, package, packages_qty, qty_per_package,
+                    from_address, to_address, additional_info_from, additional_info_to, realm)
+    # Unique per render, so labels made within the same second (e.g. of the same order) never share their files
+    now = f'{datetime.now().strftime("%Y-%m-%d_%H:%M:%S")}_{uuid.uuid4().hex[:8]}'
+
+    if order_series is None:  # Fetched before rendering (once for all the chunks), within the "fetch" stage
+        order_series = get_order_series(order_n, realm, deadline)
+
+    if not pdf_concatenation or label_chunk_size <= 0 or packages_qty is None or packages_qty <= label_chunk_size:
+        file_name = render_workbook(now, '', None, order_series, deadline, *label_inputs)
+        return 'Success', generate_pdf(file_name, deadline)
+
+    chunks = [range(first, min(first + label_chunk_size, packages_qty))
+              for first in range(0, packages_qty, label_chunk_size)]
+
+    def render_chunk(i: int, pages: range) -> str:
+        suffix = f'_-_part_{i + 1}'
+        return convert_to_pdf(render_workbook(now, suffix, pages, order_series, deadline, *label_inputs), deadline)
 
-    if status == 'Finished':
-        logging.info('Label made successfully!\n')
+    with borrow_conversion_slots(len(chunks) - 1) as borrowed, \
+            ThreadPoolExecutor(max_workers=1 + borrowed, thread_name_prefix='label_chunk') as executor:
+        futures = [executor.submit(render_chunk, i, pages) for i, pages in enumerate(chunks)]
+        wait(futures)
+
+    paths_to_parts = [future.result() for future in futures if future.exception() is None]
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    if errors:
+        for path_to_part in paths_to_parts:
+            if os.path.isfile(path_to_part):
+                os.remove(path_to_part)
+        raise errors[0]
+
+    path_to_pdf = paths_to_parts[0].replace('_-_part_1.pdf', '.pdf')
+    concatenate_pdfs(paths_to_parts, path_to_pdf)
+    logging.info(f'Label of {packages_qty} pages rendered in {len(chunks)} chunks!\n')
+
+    return 'Success', publish_pdf(path_to_pdf, deadline)
+
+
+def render_workbook(
+        now: str,
+        suffix: str,
+        pages: range,
+        order_series: pd.Series,
+        deadline: float,
+        template: str,
+        order_n: int,
+        selected_item: list,
+        add_job_info: str,
+        package: str,
+        packages_qty: int,
+        qty_per_package: list,
+        from_address: str,
+        to_address: str,
+        additional_info_from: str,
+        additional_info_to: str,
+        realm: str
+) -> str:
+    """
+    Fills the template with the label data (all the pages, or a chunk of them) and saves it as an Excel file (.xlsx),
+    with openpyxl or, if "xml_fill" is True, with the XML fill engine. See "output_label" for the other arguments.
+
+    Arguments:
+        now (str): the date and time of the label (plus a unique ID), used in the file name.
+        suffix (str): the suffix of the file name (e.g. "_-_part_2" for the second chunk).
+        pages (range): the pages to be rendered, or None for all of them.
+
+    Returns:
+        str: the name of the Excel file.
+    """
+
+    if order_series is None:  # Fetched outside the "render" stage, so its time counts against the "fetch" one
+        order_series = get_order_series(order_n, realm, deadline)
+
+    if xml_fill:
+        with stage(deadline, 'render') as timeout:
+            end = time.monotonic() + timeout
+            label_pages, order_n = get_label_pages(
+                template,
+                order_series,
+                selected_item,
+                order_n,
+                add_job_info,
+                package,
+                packages_qty,
+                qty_per_package,
+                from_address,
+                to_address,
+                additional_info_from,
+                additional_info_to,
+                pages
+            )
+            content = fill_workbook(template, label_pages)
+            if time.monotonic() > end:
+                raise DeadlineExceeded('render')
+
+            file_name = f'final_label_-_{now}_-_Order_{order_n}{suffix}.xlsx'
+            with open(file_name, 'wb') as file:
+                file.write(content)
+
+            logging.info(f'File {file_name} saved!\n')
+
+        return file_name
+
+    try:
+        wb = load_workbook(io.BytesIO(get_template_bytes(template)))
+    except Exception as e:
+        logging.error('''Error when loading the template!''')
+        logging.critical(f'''Exception: {e}''')
+
+    with stage(deadline, 'render') as timeout:
+        wb, status, order_n = make_label(
+            template,
+            order_series,
+            selected_item,
+            wb,
+            order_n,
+            add_job_info,
+            package,
+            packages_qty,
+            qty_per_package,
+            from_address,
+            to_address,
+            additional_info_from,
+            additional_info_to,
+            realm=realm,
+            deadline=time.monotonic() + timeout,  # The pages stop at the end of the "render" stage
+            pages=pages
+        )
 
-    now = datetime.now().strftime("%Y-%m-%d_%H:%M")
-    file_name = f'final_label_-_{now}_-_Order_{order_n}.xlsx'
+        if status == 'Finished':
+            logging.info('Label made successfully!\n')
 
-    wb.save(file_name)
-    logging.info(f'File {file_name} saved!\n')
+        file_name = f'final_label_-_{now}_-_Order_{order_n}{suffix}.xlsx'
 
-    link_to_pdf = generate_pdf(file_name)
+        wb.save(file_name)
+        logging.info(f'File {file_name} saved!\n')
 
-    return 'Success', link_to_pdf
+    return file_name
 
 
 if __name__ == '__main__':
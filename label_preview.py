@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+# ************************************************************#
+#  Label Generator for QBO                                   #
+#                                                            #
+#  Written by Yuri H. Galvao <yuri@galvao.ca>, January 2024  #
+# ************************************************************#
+
+import io
+from functools import lru_cache
+
+from openpyxl import load_workbook
+from openpyxl.utils import get_column_letter
+from PIL import Image, ImageDraw, ImageFont
+
+from basic_functions import logging, on_premises
+from label_generator import get_label_cells, get_label_data, label_column_widths
+
+# Declaring some variables
+preview_dpi = 60  # Low resolution is enough for checking the label, and keeps the preview fast
+label_columns = ('A', 'B', 'C', 'D', 'E')
+label_rows = range(1, 13)
+
+column_widths = label_column_widths[on_premises]  # Same column widths that "make_label" sets on every label
+
+
+# Defining functions
+@lru_cache(maxsize=None)
+def get_font(size: int, bold: bool) -> object:
+    """
+    Loads (only once per size and weight) the font to be used for drawing the preview.
+
+    Arguments:
+        size (int): the font size, in pixels.
+        bold (bool): if True, loads the bold version of the font.
+
+    Returns:
+        object: a Pillow font object.
+    """
+
+    try:
+        return ImageFont.truetype('DejaVuSans-Bold.ttf' if bold else 'DejaVuSans.ttf', size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+@lru_cache(maxsize=None)
+def get_template_layout(template: str) -> dict:
+    """
+    Reads (only once per template) the layout of the label template: cell boxes, styles, static texts and logo.
+
+    Arguments:
+        template (str): the template number ('' or '2').
+
+    Returns:
+        dict: a dictionary containing the page size, the boxes and styles of the cells and the logo image.
+    """
+
+    wb = load_workbook(f'./templates/template{template}.xlsx')
+    ws = wb.worksheets[0]
+    scale = preview_dpi / 72  # From points to pixels
+
+    ## Column widths are in characters (~7 px at 96 DPI, i.e. 5.25 pt, plus padding)
+    x = [0]
+    for column in label_columns:
+        x.append(x[-1] + (column_widths[column] * 7 + 5) * .75 * scale)
+
+    y = [0]
+    for row in label_rows:
+        height = ws.row_dimensions[row].height or 15
+        y.append(y[-1] + height * scale)
+
+    merged = {}
+    hidden = set()
+    for cell_range in ws.merged_cells.ranges:
+        merged[f'{get_column_letter(cell_range.min_col)}{cell_range.min_row}'] = cell_range
+        for row in range(cell_range.min_row, cell_range.max_row + 1):
+            for col in range(cell_range.min_col, cell_range.max_col + 1):
+                if (row, col) != (cell_range.min_row, cell_range.min_col):
+                    hidden.add(f'{get_column_letter(col)}{row}')
+
+    cells = {}
+    for row in label_rows:
+        for col, column in enumerate(label_columns, 1):
+            coordinate = f'{column}{row}'
+            if coordinate in hidden:
+                continue
+
+            cell = ws[coordinate]
+            cell_range = merged.get(coordinate)
+            last_col, last_row = (cell_range.max_col, cell_range.max_row) if cell_range else (col, row)
+            cells[coordinate] = {
+                'box': (x[col - 1], y[row - 1], x[last_col], y[last_row]),
+                'value': cell.value,
+                'size': round((cell.font.sz or 11) * scale),
+                'bold': bool(cell.font.b),
+                'horizontal': cell.alignment.horizontal or 'general',
+                'vertical': cell.alignment.vertical or 'bottom',
+                'wrap': bool(cell.alignment.wrap_text),
+                'rotated': bool(cell.alignment.textRotation),
+            }
+
+    logo = None
+    for image in ws._images:
+        anchor = image.anchor._from
+        logo_size = (round(image.width * .75 * scale), round(image.height * .75 * scale))
+        logo = {
+            'position': (round(x[anchor.col]), round(y[anchor.row])),
+            'image': Image.open('logo_for_xlsx.png').convert('RGBA').resize(logo_size),
+        }
+
+    return {'size': (round(x[-1]), round(y[-1])), 'cells': cells, 'logo': logo}
+
+
+def wrap_text(draw: object, text: str, font: object, width: float) -> list:
+    """
+    Breaks a text into lines that fit into the given width, like a cell with "wrap text" enabled does.
+
+    Arguments:
+        draw (object): the Pillow drawing object.
+        text (str): the text to be wrapped.
+        font (object): the Pillow font object.
+        width (float): the available width, in pixels.
+
+    Returns:
+        list: a list containing the lines of text.
+    """
+
+    lines = []
+    for paragraph in text.split('\n'):
+        line = ''
+        for word in paragraph.split(' '):
+            candidate = f'{line} {word}' if line else word
+            if line and draw.textlength(candidate, font=font) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+
+        lines.append(line)
+
+    return lines
+
+
+def draw_label(template: str, label_cells: dict) -> bytes:
+    """
+    Draws the first page of the label as a PNG image, straight from the cell values (no workbook, no PDF).
+
+    Arguments:
+        template (str): the template number ('' or '2').
+        label_cells (dict): the cell values, as returned by "get_label_cells".
+
+    Returns:
+        bytes: the PNG image.
+    """
+
+    layout = get_template_layout('' if template in ('', ' ', '1', None) else template)
+    image = Image.new('RGB', layout['size'], 'white')
+    draw = ImageDraw.Draw(image)
+
+    if layout['logo'] is not None:
+        image.paste(layout['logo']['image'], layout['logo']['position'], layout['logo']['image'])
+
+    for coordinate, cell in layout['cells'].items():
+        value = label_cells.get(coordinate, cell['value'])
+        if value in (None, ''):
+            continue
+
+        left, top, right, bottom = cell['box']
+        font = get_font(cell['size'], cell['bold'])
+        text = str(value)
+
+        if cell['rotated']:  # The vertical titles ("FROM", "SHIP TO" etc.)
+            title = Image.new('L', (round(draw.textlength(text, font=font)) + 1, round(cell['size'] * 1.2)), 0)
+            ImageDraw.Draw(title).text((0, 0), text, fill=255, font=font)
+            title = title.rotate(90, expand=True)
+            position = (round((left + right - title.width) / 2), round((top + bottom - title.height) / 2))
+            image.paste('black', position, title)
+            continue
+
+        lines = wrap_text(draw, text, font, right - left) if cell['wrap'] else text.rstrip('\n').split('\n')
+        line_height = cell['size'] * 1.2
+        text_height = line_height * len(lines)
+
+        if cell['vertical'] == 'top':
+            line_y = top
+        elif cell['vertical'] == 'center':
+            line_y = top + (bottom - top - text_height) / 2
+        else:
+            line_y = bottom - text_height
+
+        for line in lines:
+            line_width = draw.textlength(line, font=font)
+            if cell['horizontal'] == 'center':
+                line_x = left + (right - left - line_width) / 2
+            elif cell['horizontal'] == 'right':
+                line_x = right - line_width
+            else:
+                line_x = left
+
+            draw.text((line_x, line_y), line, fill='black', font=font)
+            line_y += line_height
+
+    png = io.BytesIO()
+    image.save(png, format='PNG', compress_level=1)
+
+    return png.getvalue()
+
+
+def preview_label(
+        template: str = '',
+        order_series: object = None,
+        order_n: int = None,
+        selected_item: list = None,
+        add_job_info: str = None,
+        package: str = None,
+        packages_qty: int = None,
+        qty_per_package: list = None,
+        from_address: str = [],
+        to_address: str = [],
+        additional_info_from: str = None,
+        additional_info_to: str = None
+) -> bytes:
+    """
+    Generates a low-resolution preview of the first page of a shipping label, using the same inputs as
+    "output_label", but without filling the workbook, converting it into PDF or uploading it.
+
+    Arguments:
+        See "output_label".
+
+    Returns:
+        bytes: the PNG image of the first page of the label.
+    """
+
+    from_address, to_address, job_details, selected_item = get_label_data(
+        order_series,
+        selected_item,
+        order_n,
+        add_job_info,
+        package,
+        packages_qty,
+        qty_per_package,
+        from_address,
+        to_address,
+        additional_info_from,
+        additional_info_to
+    )
+
+    checked_items = int(len(qty_per_package) / packages_qty)
+    label_cells = get_label_cells(template, selected_item, from_address, to_address, job_details, 0, checked_items)
+    logging.info(f'Preview of the label for {job_details[0]} drawn.')
+
+    return draw_label(template, label_cells)
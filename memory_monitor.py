@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+# ************************************************************#
+#  Label Generator for QBO                                   #
+#                                                            #
+#  Written by Yuri H. Galvao <yuri@galvao.ca>, January 2024  #
+# ************************************************************#
+
+import collections
+import gc
+import hmac
+import os
+import resource
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+from admission import admission_condition, admission_state, base_memory, capacity, detect_memory, memory_per_conversion
+from basic_functions import args, logging
+
+# Declaring some variables
+memory_sample_interval = float(os.environ.get('MEMORY_SAMPLE_INTERVAL', 60))  # In seconds
+memory_samples_max = 120  # Samples kept for the "/_memory" endpoint
+## If True, the Python allocations are traced, so the snapshots show which lines of code hold the memory (slower)
+trace_memory = True if '--trace-memory' in args or os.environ.get('MEMORY_TRACEMALLOC') == '1' else False
+trace_top_n = int(os.environ.get('MEMORY_TOP_N', 10))
+
+## Recycling policy: the worker is replaced once it crosses the memory ceiling or serves this quantity of labels.
+## The LibreOffice processes share the container's memory but not the worker's RSS, so by default the ceiling is the
+## memory left after reserving their share (see "admission.py").
+memory_ceiling = int(float(os.environ.get('MEMORY_CEILING_MB', 0)) * 2 ** 20) or \
+    max(base_memory, detect_memory() - capacity * memory_per_conversion)  # Bytes
+max_labels = int(os.environ.get('LABEL_MAX_REQUESTS', 0))  # 0 means no limit
+## Secret required by the "/_memory" endpoint; if empty, the endpoint is disabled
+memory_admin_token = os.environ.get('MEMORY_ADMIN_TOKEN', '')
+
+memory_samples = collections.deque(maxlen=memory_samples_max)
+memory_state = {
+    'labels': 0,
+    'started_at': time.time(),
+    'recycle_reason': '',  # Why the worker is going to be recycled (empty if it is not)
+    'recycling': False,  # True once the worker was asked to stop
+    'baseline': None,  # First tracemalloc snapshot, to which the later ones are compared
+    'top': [],  # Lines of code whose allocations grew the most since the baseline
+}
+memory_lock = threading.Lock()
+memory_monitor = None
+
+
+# Defining functions
+def get_rss() -> int:
+    """
+    Reads the resident set size (RSS) of the process.
+
+    Returns:
+        int: the RSS, in bytes.
+    """
+
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # Peak RSS, in kB on Linux
+
+
+def take_trace_snapshot() -> list:
+    """
+    Takes a tracemalloc snapshot and compares it to the baseline (the first snapshot).
+
+    Returns:
+        list: the "trace_top_n" lines of code whose allocations grew the most, as dictionaries.
+    """
+
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+    ))
+
+    with memory_lock:
+        if memory_state['baseline'] is None:
+            memory_state['baseline'] = snapshot
+
+        baseline = memory_state['baseline']
+
+    return [{
+        'line': str(stat.traceback[0]),
+        'size_kb': round(stat.size / 1024, 1),
+        'growth_kb': round(stat.size_diff / 1024, 1),
+        'count': stat.count,
+    } for stat in snapshot.compare_to(baseline, 'lineno')[:trace_top_n]]
+
+
+def take_memory_sample() -> dict:
+    """
+    Records the memory used by the process (and, if "trace_memory" is True, the tracemalloc top-N), then checks the
+    recycling policy.
+
+    Returns:
+        dict: the sample.
+    """
+
+    sample = {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'rss_mb': round(get_rss() / 2 ** 20, 1),
+        'labels': memory_state['labels'],
+        'gc_objects': len(gc.get_objects()),
+    }
+
+    if trace_memory:
+        top = take_trace_snapshot()
+        sample['traced_mb'] = round(tracemalloc.get_traced_memory()[0] / 2 ** 20, 1)
+        with memory_lock:
+            memory_state['top'] = top
+
+    with memory_lock:
+        memory_samples.append(sample)
+
+    check_recycling()
+
+    return sample
+
+
+def monitor_memory() -> None:
+    """
+    Takes a memory sample every "memory_sample_interval" seconds, forever.
+    """
+
+    while True:
+        try:
+            take_memory_sample()
+        except Exception as e:
+            logging.error(f'Error when sampling the memory! Exception: {repr(e)}')
+
+        time.sleep(memory_sample_interval)
+
+
+def start_memory_monitor() -> None:
+    """
+    Starts the memory sampling (in a background thread), once per process.
+    """
+
+    global memory_monitor
+
+    with memory_lock:
+        if memory_monitor is not None and memory_monitor.is_alive():
+            return
+
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        memory_monitor = threading.Thread(target=monitor_memory, name='memory_monitor', daemon=True)
+        memory_monitor.start()
+
+    logging.info(f'Memory monitor started (ceiling: {memory_ceiling / 2 ** 20:.0f} MB, '
+                 f'labels per worker: {max_labels or "unlimited"}, tracemalloc: {trace_memory}).')
+
+
+def count_label() -> None:
+    """
+    Counts a finished label (for the recycling policy) and checks whether the worker should be recycled.
+    """
+
+    with memory_lock:
+        memory_state['labels'] += 1
+
+    check_recycling()
+
+
+def check_recycling() -> None:
+    """
+    Applies the recycling policy: once the worker crosses the memory ceiling or the label limit, it is stopped as
+    soon as no label is in progress. Gunicorn lets the other requests finish (see "--graceful-timeout") and starts a
+    fresh worker. When the app is not running under Gunicorn, the need for recycling is only logged.
+    """
+
+    rss = get_rss()
+    with memory_lock:
+        if not memory_state['recycle_reason']:
+            if rss > memory_ceiling:
+                memory_state['recycle_reason'] = f'RSS of {rss / 2 ** 20:.0f} MB above the ceiling'
+            elif 0 < max_labels <= memory_state['labels']:
+                memory_state['recycle_reason'] = f'{memory_state["labels"]} labels served'
+
+            if memory_state['recycle_reason']:
+                logging.warning(f'The worker needs to be recycled: {memory_state["recycle_reason"]}.')
+
+        if not memory_state['recycle_reason'] or memory_state['recycling']:
+            return
+
+        if 'gunicorn.arbiter' not in sys.modules:
+            return
+
+        with admission_condition:
+            if admission_state['in_flight'] + admission_state['queued'] > 0:
+                return  # The last label to finish checks again
+
+        memory_state['recycling'] = True
+
+    logging.warning(f'Recycling the worker (PID {os.getpid()}): {memory_state["recycle_reason"]}.')
+    os.kill(os.getpid(), signal.SIGTERM)  # Graceful shutdown of the Gunicorn worker
+
+
+def check_admin_token(token: str) -> bool:
+    """
+    Checks whether a request to the "/_memory" endpoint is allowed: it must carry "memory_admin_token", and no
+    request is allowed if that token is not set.
+
+    Arguments:
+        token (str): the token sent with the request (empty if none).
+
+    Returns:
+        bool: True if the request is allowed, False otherwise.
+    """
+
+    if not memory_admin_token:
+        return False
+
+    return hmac.compare_digest(token.encode(), memory_admin_token.encode())
+
+
+def get_memory_status(snapshot: bool = False) -> dict:
+    """
+    Reports the memory used by the worker over time, the lines of code holding the most memory (if tracemalloc is
+    on) and the state of the recycling policy.
+
+    Arguments:
+        snapshot (bool, optional): if True, takes a new sample before reporting. Default is False.
+
+    Returns:
+        dict: a dictionary containing the current RSS, the samples, the tracemalloc top-N and the recycling state.
+    """
+
+    if snapshot:
+        take_memory_sample()
+
+    with memory_lock:
+        return {
+            'pid': os.getpid(),
+            'rss_mb': round(get_rss() / 2 ** 20, 1),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'ceiling_mb': round(memory_ceiling / 2 ** 20, 1),
+            'labels': memory_state['labels'],
+            'max_labels': max_labels,
+            'uptime_seconds': round(time.time() - memory_state['started_at']),
+            'recycle_reason': memory_state['recycle_reason'],
+            'tracemalloc': trace_memory,
+            'top': list(memory_state['top']),
+            'samples': list(memory_samples),
+        }
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+# ************************************************************#
+#  Label Generator for QBO                                   #
+#                                                            #
+#  Written by Yuri H. Galvao <yuri@galvao.ca>, January 2024  #
+# ************************************************************#
+
+import hashlib
+import importlib.util
+import os
+import time
+from contextlib import ExitStack
+
+from basic_functions import args, logging
+
+# Declaring some variables
+# If False, the PDF files are uploaded just as LibreOffice exports them
+pdf_optimization = False if '--no-pdf-optimization' in args or os.environ.get('PDF_OPTIMIZATION') == '0' else True
+pdf_concatenation = importlib.util.find_spec('pikepdf') is not None  # If False, labels are not split into chunks
+
+
+# Defining functions
+def get_image_key(image: object) -> str:
+    """
+    Computes a key that identifies an image XObject by its content, so identical copies of the same image (e.g. the
+    logo, which is added to every page of the label) get the same key.
+
+    Arguments:
+        image (object): the pikepdf image XObject (a stream object).
+
+    Returns:
+        str: the key of the image.
+    """
+
+    key = hashlib.sha256(image.read_raw_bytes())
+    for name in sorted(image.keys()):
+        if name == '/Length':
+            continue
+        elif name == '/SMask':  # The transparency mask is an image itself
+            key.update(get_image_key(image.SMask).encode())
+        else:
+            key.update(f'{name}={repr(image[name])}'.encode())
+
+    return key.hexdigest()
+
+
+def deduplicate_images(pdf: object) -> int:
+    """
+    Makes every page of the PDF file point to a single copy of each distinct image.
+
+    Arguments:
+        pdf (object): the pikepdf PDF object.
+
+    Returns:
+        int: the quantity of image copies that are no longer referenced.
+    """
+
+    first_images = {}
+    replaced = set()
+    visited = set()
+
+    def deduplicate(resources: object) -> None:
+        xobjects = resources.get('/XObject') if resources is not None else None
+        if xobjects is None:
+            return
+
+        for name in list(xobjects.keys()):
+            xobject = xobjects[name]
+            if xobject.get('/Subtype') == '/Form' and xobject.objgen not in visited:
+                visited.add(xobject.objgen)
+                deduplicate(xobject.get('/Resources'))
+            elif xobject.get('/Subtype') == '/Image':
+                first_image = first_images.setdefault(get_image_key(xobject), xobject)
+                if first_image.objgen != xobject.objgen:
+                    xobjects[name] = first_image
+                    replaced.add(xobject.objgen)
+
+    for page in pdf.pages:
+        deduplicate(page.obj.get('/Resources'))
+
+    return len(replaced)
+
+
+def optimize_pdf(path_to_file: str) -> dict:
+    """
+    Shrinks a PDF file (in place): deduplicates identical images across pages, drops unreferenced resources,
+    recompresses the streams and packs the objects into compressed object streams. The fonts are not touched, since
+    LibreOffice already embeds only the subsets of the glyphs that are used.
+
+    Arguments:
+        path_to_file (str): the local file path of the PDF file.
+
+    Returns:
+        dict: a report containing the sizes (in bytes) before and after, the deduplicated images and the time spent.
+    """
+
+    start = time.perf_counter()
+    report = {'bytes_before': os.path.getsize(path_to_file), 'images_deduplicated': 0, 'optimized': False}
+
+    if pdf_optimization:
+        try:
+            import pikepdf  # Optional dependency
+        except ImportError:
+            logging.warning('The "pikepdf" package is not installed, so the PDF file will not be optimized.')
+        else:
+            optimized_file = path_to_file[:-4] + '_optimized.pdf'
+            try:
+                with pikepdf.open(path_to_file) as pdf:
+                    report['images_deduplicated'] = deduplicate_images(pdf)
+                    pdf.remove_unreferenced_resources()
+                    pdf.save(
+                        optimized_file,
+                        compress_streams=True,
+                        recompress_flate=True,
+                        object_stream_mode=pikepdf.ObjectStreamMode.generate
+                    )
+
+                if os.path.getsize(optimized_file) < report['bytes_before']:
+                    os.replace(optimized_file, path_to_file)
+                    report['optimized'] = True
+            except Exception as e:
+                logging.error(f'''Error when optimizing the PDF file! Exception: {repr(e)}''')
+            finally:
+                if os.path.isfile(optimized_file):
+                    os.remove(optimized_file)
+
+    report['bytes_after'] = os.path.getsize(path_to_file)
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    logging.info(
+        f'''PDF optimization: {report['bytes_before']} -> {report['bytes_after']} bytes '''
+        f'''({report['images_deduplicated']} duplicated images) in {report['seconds']} s.'''
+    )
+
+    return report
+
+
+def concatenate_pdfs(paths_to_files: list, path_to_file: str) -> None:
+    """
+    Concatenates PDF files, in the given order, into a single PDF file. The original files are removed.
+
+    Arguments:
+        paths_to_files (list): the local file paths of the PDF files, in order.
+        path_to_file (str): the local file path of the resulting PDF file.
+    """
+
+    import pikepdf  # Optional dependency (see "pdf_concatenation")
+
+    try:
+        with ExitStack() as stack, pikepdf.new() as pdf:
+            for path_to_part in paths_to_files:
+                part = stack.enter_context(pikepdf.open(path_to_part))  # Must stay open until the result is saved
+                pdf.pages.extend(part.pages)
+
+            pdf.save(path_to_file)
+    finally:
+        for path_to_part in paths_to_files:
+            if os.path.isfile(path_to_part):
+                os.remove(path_to_part)
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+# ************************************************************#
+#  Label Generator for QBO                                   #
+#                                                            #
+#  Written by Yuri H. Galvao <yuri@galvao.ca>, January 2024  #
+# ************************************************************#
+
+import os
+import queue
+import subprocess as subp
+import tempfile
+import threading
+import time
+
+from basic_functions import args, logging, on_premises
+
+# Declaring some variables
+## Local printer queue (CUPS) that receives the labels when running on premises. If empty, the labels are uploaded.
+printer = next((arg.split('=', 1)[1] for arg in args if arg.startswith('--printer=')), '') or \
+    os.environ.get('LABEL_PRINTER', '')
+print_server = os.environ.get('LABEL_PRINT_SERVER', '')  # IPP server (host[:port]); empty means the local CUPS
+print_batch_window = float(os.environ.get('LABEL_PRINT_BATCH_WINDOW', .25))  # In seconds
+print_batch_max = 20  # Maximum quantity of labels in a single print job
+print_retries = int(os.environ.get('LABEL_PRINT_RETRIES', 3))  # Further attempts for a label whose print job failed
+print_retry_delay = float(os.environ.get('LABEL_PRINT_RETRY_DELAY', 5))  # In seconds (doubled at each attempt)
+## Where the labels wait to be printed (each one under a unique name, so a later label never overwrites a queued one)
+print_spool_dir = os.environ.get('LABEL_PRINT_SPOOL_DIR', './output/print_spool')
+## Where the labels that could not be printed are kept, so they can be printed by hand
+failed_prints_dir = os.environ.get('LABEL_FAILED_PRINTS_DIR', './output/failed_prints')
+
+direct_printing = on_premises and printer != ''
+print_queue = queue.Queue()
+print_attempts = {}  # Failed attempts of each label, by file path
+print_worker = None
+print_worker_lock = threading.Lock()
+
+
+# Defining functions
+def submit_print_job(paths_to_files: list) -> str:
+    """
+    Submits one print job, containing one or more PDF files, to the printer queue over IPP (through CUPS' "lp").
+
+    Arguments:
+        paths_to_files (list): the local file paths of the PDF files, in printing order.
+
+    Returns:
+        str: the message returned by "lp" (e.g. "request id is Zebra-12 (2 file(s))").
+    """
+
+    cmd = ['lp', '-d', printer]
+    if print_server:
+        cmd += ['-h', print_server]
+
+    cmd += ['-t', f'Labels ({len(paths_to_files)})', '--'] + paths_to_files
+    p = subp.run(cmd, capture_output=True, text=True, check=True)
+
+    return p.stdout.strip()
+
+
+def print_labels() -> None:
+    """
+    Sends the queued labels to the printer, forever. The labels queued within "print_batch_window" seconds of each
+    other are sent together, as a single print job. Each item of "print_queue" is a list of labels that are kept
+    together and in order (e.g. the labels of a print job that failed and is being sent again).
+    """
+
+    while True:
+        items = [print_queue.get()]
+        deadline = time.monotonic() + print_batch_window
+        while sum(len(item) for item in items) < print_batch_max:
+            try:
+                items.append(print_queue.get(timeout=max(0., deadline - time.monotonic())))
+            except queue.Empty:
+                break
+
+        batch = [path_to_file for item in items for path_to_file in item]
+        try:
+            logging.info(f'Printing {len(batch)} label(s) on "{printer}": {submit_print_job(batch)}')
+        except Exception as e:
+            logging.error(f'''Error when printing the label(s) {batch}! Exception: {repr(e)}''')
+            retry_labels(batch)
+        else:
+            for path_to_file in batch:
+                print_attempts.pop(path_to_file, None)
+                if os.path.isfile(path_to_file):
+                    os.remove(path_to_file)
+        finally:
+            for _ in items:
+                print_queue.task_done()
+
+
+def retry_labels(paths_to_files: list) -> None:
+    """
+    Queues the labels of a failed print job to be printed again, together and in the same order, after a delay that
+    doubles at each attempt. After "print_retries" attempts, a label is moved to "failed_prints_dir" instead (see
+    "keep_failed_label").
+
+    Arguments:
+        paths_to_files (list): the local file paths of the PDF files, in printing order.
+    """
+
+    retried = {}  # Labels to be printed again, by attempt, in printing order
+    for path_to_file in paths_to_files:
+        attempts = print_attempts.get(path_to_file, 0) + 1
+        if attempts <= print_retries and os.path.isfile(path_to_file):
+            print_attempts[path_to_file] = attempts
+            retried.setdefault(attempts, []).append(path_to_file)
+        else:
+            keep_failed_label(path_to_file, attempts)
+
+    for attempts, paths_to_retry in retried.items():
+        delay = print_retry_delay * 2 ** (attempts - 1)
+        logging.warning(f'Label(s) {paths_to_retry} will be printed again in {delay} s (attempt {attempts + 1}).')
+        timer = threading.Timer(delay, print_queue.put, args=(paths_to_retry,))
+        timer.daemon = True
+        timer.start()
+
+
+def keep_failed_label(path_to_file: str, attempts: int) -> None:
+    """
+    Moves a label that could not be printed to "failed_prints_dir", so it is not lost, and logs where it is.
+
+    Arguments:
+        path_to_file (str): the local file path of the PDF file.
+        attempts (int): the quantity of print jobs that failed.
+    """
+
+    print_attempts.pop(path_to_file, None)
+    if not os.path.isfile(path_to_file):
+        logging.critical(f'Label {path_to_file} could not be printed on "{printer}", and its file is gone!')
+        return
+
+    os.makedirs(failed_prints_dir, exist_ok=True)
+    kept_file = os.path.join(failed_prints_dir, os.path.basename(path_to_file))
+    os.replace(path_to_file, kept_file)
+    logging.critical(f'Label {path_to_file} could not be printed on "{printer}" after {attempts} attempts! '
+                     f'It was kept in {kept_file}.')
+
+
+def spool_label(path_to_file: str) -> str:
+    """
+    Queues a label (PDF file) to be printed, returning right away. The file is first moved to "print_spool_dir",
+    under a unique name, and it is removed after being sent.
+
+    Arguments:
+        path_to_file (str): the local file path of the PDF file.
+
+    Returns:
+        str: the local file path of the spooled PDF file.
+    """
+
+    global print_worker
+
+    with print_worker_lock:
+        if print_worker is None or not print_worker.is_alive():
+            print_worker = threading.Thread(target=print_labels, name='print_spooler', daemon=True)
+            print_worker.start()
+
+    os.makedirs(print_spool_dir, exist_ok=True)
+    file, spooled_file = tempfile.mkstemp(suffix='.pdf', prefix=os.path.basename(path_to_file)[:-4] + '_-_',
+                                          dir=print_spool_dir)
+    os.close(file)
+    os.replace(path_to_file, spooled_file)
+
+    print_queue.put([spooled_file])
+    logging.info(f'Label {path_to_file} queued for printing on "{printer}" (as {spooled_file}).')
+
+    return spooled_file
+
+
+if __name__ == '__main__':
+    # Check of the batching and of the failure path (run it with: python print_spooler.py --on-premises), first
+    # against a fake "lp" and then, if CUPS' "lp" is installed, over IPP against the stand-in printer of
+    # "ipp_emulator.py" (through "print_server"). It exits with status 1 if any check fails.
+    import glob
+    import hashlib
+    import shutil
+    import sys
+
+    from ipp_emulator import emulator_config, jobs, start_ipp_emulator, stats
+
+    cups_lp = shutil.which('lp')
+    path = os.environ['PATH']
+    temp_dir = tempfile.mkdtemp()
+    calls_file = os.path.join(temp_dir, 'lp_calls.txt')
+    fail_file = os.path.join(temp_dir, 'fail')  # While it exists, "lp" fails; if it contains "once", only once
+    with open(os.path.join(temp_dir, 'lp'), 'w') as file:
+        file.write(f"""#!/bin/sh
+echo "$@" >> {calls_file}
+if [ -f {fail_file} ]; then
+    grep -q once {fail_file} && rm {fail_file}
+    echo "lp: Unable to connect to the printer" >&2
+    exit 1
+fi
+echo "request id is Test-1"
+""")
+    os.chmod(os.path.join(temp_dir, 'lp'), 0o755)
+    os.environ['PATH'] = temp_dir + os.pathsep + path
+
+    printer = 'Test'
+    print_batch_window = .5
+    print_retries = 1
+    print_retry_delay = .2
+    print_spool_dir = os.path.join(temp_dir, 'spool')
+    failed_prints_dir = os.path.join(temp_dir, 'failed')
+
+    def make_labels(name: str, quantity: int) -> list:
+        paths_to_files = [os.path.join(temp_dir, f'{name}_{n}.pdf') for n in range(quantity)]
+        for n, path_to_file in enumerate(paths_to_files):
+            open(path_to_file, 'wb').write(f'%PDF-1.4 {name} {n}'.encode())
+        return paths_to_files
+
+    def read_calls() -> list:
+        calls = open(calls_file).read().splitlines() if os.path.isfile(calls_file) else []
+        open(calls_file, 'w').close()
+        return calls
+
+    def wait_until(condition: object, timeout: float = 10.) -> bool:
+        end = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > end:
+                return False
+            time.sleep(.05)
+        return True
+
+    def in_order(call: str, paths_to_files: list) -> bool:
+        positions = [call.find(path_to_file) for path_to_file in paths_to_files]
+        return -1 not in positions and positions == sorted(positions)
+
+    results = {}
+
+    labels = [spool_label(path_to_file) for path_to_file in make_labels('batch', 3)]
+    print_queue.join()
+    calls = read_calls()
+    results['labels queued together are sent as one print job'] = len(calls) == 1 and in_order(calls[0], labels)
+    results['printed labels are removed'] = not any(os.path.isfile(path_to_file) for path_to_file in labels)
+
+    open(fail_file, 'w').write('once')
+    labels = [spool_label(path_to_file) for path_to_file in make_labels('retry', 3)]
+    results['a failed print job is sent again'] = \
+        wait_until(lambda: not any(os.path.isfile(path_to_file) for path_to_file in labels))
+    calls = read_calls()
+    results['... as one print job, in the same order'] = len(calls) == 2 and in_order(calls[1], labels)
+    results['... and its labels are not kept as failed'] = not glob.glob(os.path.join(failed_prints_dir, 'retry_*'))
+
+    open(fail_file, 'w').write('always')
+    labels = [spool_label(path_to_file) for path_to_file in make_labels('failed', 2)]
+    kept_files = [os.path.join(failed_prints_dir, os.path.basename(path_to_file)) for path_to_file in labels]
+    results['labels that cannot be printed are kept'] = \
+        wait_until(lambda: all(os.path.isfile(kept_file) for kept_file in kept_files))
+    results['... after the retries'] = len([call for call in read_calls() if labels[0] in call]) == 1 + print_retries
+
+    first, second = make_labels('same_name', 1) * 2  # "lp" still fails, so the first label stays in the spool
+    first = spool_label(first)
+    open(second, 'wb').write(b'%PDF-1.4 second')
+    second = spool_label(second)
+    results['a label with the same name does not overwrite a queued one'] = \
+        first != second and open(first, 'rb').read() == b'%PDF-1.4 same_name 0'
+    os.remove(fail_file)
+    wait_until(lambda: not os.path.isfile(first) and not os.path.isfile(second))
+
+    if cups_lp:
+        os.environ['PATH'] = path
+        server = start_ipp_emulator()
+        print_server = f'127.0.0.1:{server.server_address[1]}'
+
+        labels = [spool_label(path_to_file) for path_to_file in make_labels('ipp', 3)]
+        digests = [hashlib.md5(open(path_to_file, 'rb').read()).hexdigest() for path_to_file in labels]
+        print_queue.join()
+        results['IPP: labels queued together are sent as one print job'] = \
+            len(jobs) == 1 and jobs[0]['documents'] == digests and jobs[0]['state'] == 'completed'
+
+        emulator_config['fail_jobs'] = -1
+        labels = [spool_label(path_to_file) for path_to_file in make_labels('ipp_failed', 1)]
+        kept_file = os.path.join(failed_prints_dir, os.path.basename(labels[0]))
+        results['IPP: a refused label is kept after the retries'] = \
+            wait_until(lambda: os.path.isfile(kept_file)) and stats['refused'] == 1 + print_retries
+        server.shutdown()
+    else:
+        print('SKIPPED: IPP checks (CUPS\' "lp" is not installed)')
+
+    for check, passed in results.items():
+        print(f'{"OK" if passed else "FAILED"}: {check}')
+
+    shutil.rmtree(temp_dir)
+    sys.exit(0 if all(results.values()) else 1)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+# ************************************************************#
+#  Label Generator for QBO                                   #
+#                                                            #
+#  Written by Yuri H. Galvao <yuri@galvao.ca>, January 2024  #
+# ************************************************************#
+
+"""
+Local stand-in for the QBO API (and Intuit's OAuth server), for performance and resilience work without network or
+real credentials.
+
+Replay mode (default): answers the Invoice queries with the responses recorded in the recordings directory (or with
+synthetic invoices, if "--synthetic-lines" is set), optionally adding latency, 429 responses and token expiry.
+
+Record mode ("--record-from"): forwards the queries to the real QBO API, using the app's own tokens, and saves the
+sanitized responses in the recordings directory.
+
+To point the app at the emulator, set these environment variables before starting it:
+
+    QBO_API_URL=http://localhost:8081/v3
+    INTUIT_DISCOVERY_URL=http://localhost:8081/.well-known/openid_configuration  (replay mode only)
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import secrets
+import threading
+import time
+
+import requests
+from flask import Flask, jsonify, request
+
+# Declaring some variables
+parser = argparse.ArgumentParser(description='Record/replay stand-in for the QBO API.')
+parser.add_argument('--port', type=int, default=8081)
+parser.add_argument('--recordings', default='qbo_recordings', help='directory of the recorded responses')
+parser.add_argument('--record-from', default='', help='real API URL to record from, e.g. https://quickbooks.api.intuit.com')
+parser.add_argument('--latency', type=float, default=0., help='added latency per query, in milliseconds')
+parser.add_argument('--jitter', type=float, default=0., help='random variation of the latency, in milliseconds')
+parser.add_argument('--throttle-rate', type=float, default=0., help='fraction of queries answered with 429 (0 to 1)')
+parser.add_argument('--token-ttl', type=float, default=3600., help='lifetime of the access tokens, in seconds')
+parser.add_argument('--synthetic-lines', type=int, default=0,
+                    help='if > 0, unrecorded invoices are made up, with this quantity of product lines')
+
+## Keys whose values are replaced (keeping their length) when recording
+sensitive_keys = {
+    'Line1', 'Line2', 'Line3', 'Line4', 'Line5', 'City', 'PostalCode', 'Lat', 'Long', 'Address', 'FreeFormNumber',
+    'Description', 'PrivateNote', 'CustomerMemo', 'Note', 'name', 'DisplayName', 'CompanyName', 'GivenName',
+    'FamilyName', 'TrackingNum', 'InvoiceLink',
+}
+
+emulator = Flask(__name__)
+issued_tokens = {}  # Issuing time of each access token
+issued_tokens_lock = threading.Lock()
+stats = {'queries': 0, 'throttled': 0, 'expired': 0, 'not_found': 0, 'recorded': 0}
+
+
+# Defining functions
+def sanitize(data: object) -> object:
+    """
+    Replaces the personal and business data in a QBO response with placeholders of the same length (letters become
+    "X" and digits become "9"), keeping the structure and the sizes of the response.
+
+    Arguments:
+        data (object): the decoded JSON response (or part of it).
+
+    Returns:
+        object: the sanitized data.
+    """
+
+    if isinstance(data, dict):
+        return {key: mask(value) if key in sensitive_keys else sanitize(value) for key, value in data.items()}
+    elif isinstance(data, list):
+        return [sanitize(item) for item in data]
+
+    return data
+
+
+def mask(value: object) -> object:
+    """
+    Masks a value (see "sanitize").
+
+    Arguments:
+        value (object): the value to be masked.
+
+    Returns:
+        object: the masked value.
+    """
+
+    if isinstance(value, str):
+        return re.sub(r'\d', '9', re.sub(r'[^\W\d]', 'X', value))
+
+    return sanitize(value)
+
+
+def get_recording_path(realm: str, doc_number: str) -> str:
+    """
+    Returns the path of the recorded response for an invoice.
+
+    Arguments:
+        realm (str): the realm ID.
+        doc_number (str): the invoice number.
+
+    Returns:
+        str: the file path.
+    """
+
+    return os.path.join(emulator.config['recordings'], realm, f'Invoice_{doc_number}.json')
+
+
+def make_synthetic_invoice(doc_number: str, lines: int) -> dict:
+    """
+    Makes up an invoice with the given quantity of product lines, with the fields the label generator uses.
+
+    Arguments:
+        doc_number (str): the invoice number.
+        lines (int): the quantity of product lines.
+
+    Returns:
+        dict: the invoice, as in the QBO API responses.
+    """
+
+    products = [{
+        'Id': str(n),
+        'LineNum': n,
+        'Description': f'Product {n} - 24 x 36 in., full color, {n * 10} units',
+        'Amount': 10. * n,
+        'DetailType': 'SalesItemLineDetail',
+        'SalesItemLineDetail': {'ItemRef': {'value': str(n), 'name': f'Product {n}'}, 'Qty': n * 10, 'UnitPrice': 1},
+    } for n in range(1, lines + 1)]
+    subtotal = {'Amount': sum(line['Amount'] for line in products), 'DetailType': 'SubTotalLineDetail',
+                'SubTotalLineDetail': {}}
+
+    return {
+        'Id': doc_number,
+        'DocNumber': doc_number,
+        'SyncToken': '0',
+        'TxnDate': time.strftime('%Y-%m-%d'),
+        'CustomerRef': {'value': '1', 'name': 'Synthetic Customer Inc.'},
+        'ShipAddr': {'Id': '1', 'Line1': '123 Anywhere Street', 'Line2': 'Unit 9', 'City': 'Winnipeg',
+                     'CountrySubDivisionCode': 'MB', 'PostalCode': 'R0R 0R0'},
+        'ShipMethodRef': {'value': 'Courier', 'name': 'Courier'},
+        'Line': products + [subtotal],
+        'TotalAmt': subtotal['Amount'],
+    }
+
+
+def fault(status: int, message: str, code: str, type_: str) -> tuple:
+    """
+    Builds an error response in the QBO API format.
+
+    Arguments:
+        status (int): the HTTP status.
+        message (str): the error message.
+        code (str): the QBO error code.
+        type_ (str): the QBO fault type.
+
+    Returns:
+        tuple: the Flask response and status.
+    """
+
+    return jsonify(Fault={'Error': [{'Message': message, 'code': code}], 'type': type_}), status
+
+
+@emulator.route('/.well-known/openid_configuration')
+def discovery_document():
+    """
+    Intuit's discovery document, pointing the OAuth endpoints at the emulator.
+    """
+
+    root = request.host_url.rstrip('/')
+
+    return jsonify(
+        issuer=root,
+        authorization_endpoint=root + '/connect/oauth2',
+        token_endpoint=root + '/oauth2/v1/tokens/bearer',
+        revocation_endpoint=root + '/oauth2/v1/tokens/revoke',
+        jwks_uri=root + '/oauth2/v1/keys',
+        userinfo_endpoint=root + '/v1/openid_connect/userinfo',
+    )
+
+
+@emulator.route('/oauth2/v1/tokens/bearer', methods=['POST'])
+def issue_tokens():
+    """
+    Issues a new access token for any refresh token (the refresh token is returned unchanged).
+    """
+
+    access_token = secrets.token_urlsafe(24)
+    with issued_tokens_lock:
+        issued_tokens[access_token] = time.monotonic()
+
+    return jsonify(
+        access_token=access_token,
+        refresh_token=request.form.get('refresh_token', secrets.token_urlsafe(24)),
+        token_type='bearer',
+        expires_in=int(emulator.config['token_ttl']),
+        x_refresh_token_expires_in=8726400,
+    )
+
+
+@emulator.route('/v3/company/<realm>/query', methods=['POST'])
+def query(realm: str):
+    """
+    Answers the Invoice queries made by "Invoice.choose" (e.g. "SELECT * FROM Invoice WHERE DocNumber in ('1025')").
+    """
+
+    stats['queries'] += 1
+    select = request.get_data(as_text=True)
+    doc_numbers = re.findall(r"'([^']*)'", select)
+
+    if emulator.config['record_from']:
+        return record(realm, select, doc_numbers)
+
+    delay = emulator.config['latency'] + random.uniform(-1, 1) * emulator.config['jitter']
+    time.sleep(max(0., delay) / 1000)
+
+    access_token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    with issued_tokens_lock:
+        issued_at = issued_tokens.get(access_token)
+
+    if issued_at is None or time.monotonic() - issued_at > emulator.config['token_ttl']:
+        stats['expired'] += 1
+        return fault(401, 'message=AuthenticationFailed; errorCode=003200; statusCode=401', '3200', 'AUTHENTICATION')
+
+    if random.random() < emulator.config['throttle_rate']:
+        stats['throttled'] += 1
+        return fault(429, 'message=ThrottleExceeded; errorCode=003001; statusCode=429', '3001', 'SERVICE')
+
+    invoices = []
+    for doc_number in doc_numbers:
+        path_to_file = get_recording_path(realm, doc_number)
+        if os.path.isfile(path_to_file):
+            invoices += json.load(open(path_to_file, 'r')).get('QueryResponse', {}).get('Invoice', [])
+        elif emulator.config['synthetic_lines'] > 0:
+            invoices.append(make_synthetic_invoice(doc_number, emulator.config['synthetic_lines']))
+        else:
+            stats['not_found'] += 1
+
+    query_response = {'Invoice': invoices, 'startPosition': 1, 'maxResults': len(invoices)} if invoices else {}
+
+    return jsonify(QueryResponse=query_response, time=time.strftime('%Y-%m-%dT%H:%M:%S.000-07:00'))
+
+
+def record(realm: str, select: str, doc_numbers: list) -> tuple:
+    """
+    Forwards a query to the real QBO API, saves the sanitized response (one file per invoice) and returns the real,
+    unsanitized response to the app.
+
+    Arguments:
+        realm (str): the realm ID.
+        select (str): the query.
+        doc_numbers (list): the invoice numbers in the query.
+
+    Returns:
+        tuple: the response body, status and content type.
+    """
+
+    response = requests.post(
+        f'''{emulator.config['record_from'].rstrip('/')}/v3/company/{realm}/query''',
+        params=request.args,
+        data=select.encode(),
+        headers={
+            'Authorization': request.headers.get('Authorization', ''),
+            'Content-Type': 'application/text',
+            'Accept': 'application/json',
+        },
+        timeout=60
+    )
+
+    if response.status_code == 200:
+        body = response.json()
+        for invoice in body.get('QueryResponse', {}).get('Invoice', []):
+            path_to_file = get_recording_path(realm, invoice.get('DocNumber', ''))
+            os.makedirs(os.path.dirname(path_to_file), exist_ok=True)
+            recording = {'QueryResponse': {'Invoice': [sanitize(invoice)], 'startPosition': 1, 'maxResults': 1}}
+            open(path_to_file, 'w').write(json.dumps(recording, indent=2))
+            stats['recorded'] += 1
+            logging.info(f'Recorded {path_to_file} ({len(invoice.get("Line", []))} lines).')
+
+    return response.content, response.status_code, {'Content-Type': 'application/json'}
+
+
+@emulator.route('/_stats')
+def show_stats():
+    """
+    Reports how many queries were answered, throttled, rejected (expired token), not found and recorded.
+    """
+
+    return jsonify(stats)
+
+
+if __name__ == '__main__':
+    options = parser.parse_args()
+    emulator.config.update(
+        recordings=options.recordings,
+        record_from=options.record_from,
+        latency=options.latency,
+        jitter=options.jitter,
+        throttle_rate=options.throttle_rate,
+        token_ttl=options.token_ttl,
+        synthetic_lines=options.synthetic_lines,
+    )
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    emulator.run(host='127.0.0.1', port=options.port, threaded=True)
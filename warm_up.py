@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# ************************************************************#
+#  Label Generator for QBO                                   #
+#                                                            #
+#  Written by Yuri H. Galvao <yuri@galvao.ca>, January 2024  #
+# ************************************************************#
+
+import importlib
+import tempfile
+import threading
+import time
+
+from basic_functions import logging, on_premises
+from deadlines import run_process, stage_budgets
+
+# Declaring some variables
+warm_up_status = {}  # Readiness of each component, by component name
+warm_up_lock = threading.Lock()
+
+
+# Defining functions
+def warm_up_modules() -> None:
+    """
+    Imports the heavy modules used by the label pipeline (pandas, openpyxl, Pillow, etc.).
+    """
+
+    for module in ('pandas', 'openpyxl', 'PIL.Image', 'label_generator', 'label_preview'):
+        importlib.import_module(module)
+
+
+def warm_up_qbo_client() -> None:
+    """
+    Authenticates on Intuit, so the shared QBO session of each realm is ready for the first order.
+    """
+
+    from label_generator import get_qbo_client, realms
+
+    for realm in realms:
+        get_qbo_client(realm)
+
+
+def warm_up_storage_client() -> None:
+    """
+    Creates the Google Cloud Storage client and gets the bucket for the labels.
+    """
+
+    if on_premises:
+        return
+
+    from label_generator import gcp_project, get_bucket
+
+    get_bucket(f'{gcp_project}-processed-labels')
+
+
+def warm_up_templates() -> None:
+    """
+    Reads the label templates into memory and builds the layouts used by the label preview (and, if the XML fill
+    engine is on, the prepared template parts).
+    """
+
+    from label_generator import get_template_bytes, xml_fill
+    from label_preview import get_template_layout
+    from xlsx_filler import get_template_parts
+
+    for template in ('', '2'):
+        get_template_bytes(template)
+        get_template_layout(template)
+        if xml_fill:
+            get_template_parts(template)
+
+
+def warm_up_libreoffice() -> None:
+    """
+    Starts LibreOffice once per conversion slot (converting a template into a throwaway PDF), so the profile of each
+    slot and the libraries are ready.
+    """
+
+    from admission import capacity, conversion_slot
+    from label_generator import get_libreoffice_cmd
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for _ in range(capacity):
+            with conversion_slot(stage_budgets['convert']) as slot:
+                cmd = get_libreoffice_cmd('./templates/template.xlsx', temp_dir, slot)
+                run_process(cmd, stage_budgets['convert'], 'convert')
+
+
+warm_up_functions = {
+    'modules': warm_up_modules,
+    'qbo_client': warm_up_qbo_client,
+    'storage_client': warm_up_storage_client,
+    'templates': warm_up_templates,
+    'libreoffice': warm_up_libreoffice,
+}
+
+
+def warm_up_component(component: str) -> None:
+    """
+    Warms up a single component, recording its status and how long it took.
+
+    Arguments:
+        component (str): the name of the component (a key of "warm_up_functions").
+    """
+
+    start = time.perf_counter()
+    try:
+        warm_up_functions[component]()
+    except Exception as e:
+        logging.error(f'Error when warming up "{component}"! Exception: {repr(e)}')
+        status = {'status': 'failed', 'error': repr(e)}
+    else:
+        status = {'status': 'ready'}
+
+    status['seconds'] = round(time.perf_counter() - start, 3)
+    with warm_up_lock:
+        warm_up_status[component] = status
+
+    logging.info(f'Warm-up of "{component}": {status["status"]} in {status["seconds"]} s.')
+
+
+def warm_up(retry_failed: bool = False) -> dict:
+    """
+    Starts warming up (in parallel, in background threads) every component that was not warmed up yet.
+
+    Arguments:
+        retry_failed (bool, optional): if True, components whose warm-up failed are warmed up again.
+
+    Returns:
+        dict: the readiness of each component (see "get_warm_up_status").
+    """
+
+    with warm_up_lock:
+        for component in warm_up_functions:
+            status = warm_up_status.get(component, {}).get('status')
+            if status is None or (retry_failed and status == 'failed'):
+                warm_up_status[component] = {'status': 'warming'}
+                threading.Thread(target=warm_up_component, args=(component,), daemon=True).start()
+
+    return get_warm_up_status()
+
+
+def get_warm_up_status() -> dict:
+    """
+    Reports the readiness of each component.
+
+    Returns:
+        dict: a dictionary containing the status of each component and whether all of them are ready.
+    """
+
+    with warm_up_lock:
+        components = {component: dict(status) for component, status in warm_up_status.items()}
+
+    ready = len(components) == len(warm_up_functions) and all(
+        status['status'] == 'ready' for status in components.values())
+
+    return {'ready': ready, 'components': components}
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+
+# ************************************************************#
+#  Label Generator for QBO                                   #
+#                                                            #
+#  Written by Yuri H. Galvao <yuri@galvao.ca>, January 2024  #
+# ************************************************************#
+
+"""
+Lightweight fill engine for the label templates: instead of parsing the template, copying worksheets and
+re-serializing everything with openpyxl for every label, the template is prepared only once (with openpyxl, so the
+layout is exactly the same) and kept as the raw XML parts of the package. Each label then only writes its cell values
+into the precomputed slots of the sheet XML, duplicates the sheet part for the extra pages and zips the package
+straight into a buffer.
+
+Parity check and benchmark against openpyxl (run it from the app directory): python xlsx_filler.py --on-premises
+"""
+
+import io
+import re
+import zipfile
+from functools import lru_cache
+from xml.sax.saxutils import escape
+
+from openpyxl.cell.cell import Cell
+from openpyxl.compat import safe_string
+
+from basic_functions import on_premises
+
+# Declaring some variables
+## Cells that may get a value from "get_label_cells", for each kind of template
+slots_template_1 = ('C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8', 'C9', 'C10', 'C11', 'C12', 'D11', 'D12', 'E8')
+slots_template_2 = ('C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8', 'C9', 'C10', 'C11', 'C12', 'E8', 'E10', 'E11')
+
+worksheet_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml'
+drawing_type = 'application/vnd.openxmlformats-officedocument.drawing+xml'
+worksheet_rel = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet'
+page_parts = re.compile(r'xl/(worksheets/(_rels/)?sheet|drawings/(_rels/)?drawing)2\.xml(\.rels)?')
+
+
+# Defining functions
+def get_slots(template: str) -> tuple:
+    """
+    Returns the cells that may get a value from "get_label_cells" for a template.
+
+    Arguments:
+        template (str): the template number.
+
+    Returns:
+        tuple: the cell coordinates.
+    """
+
+    return slots_template_1 if template in ('', ' ', '1', None) else slots_template_2
+
+
+def split_sheet(sheet_xml: str, slots: tuple) -> tuple:
+    """
+    Splits the XML of a prepared sheet at its slot cells.
+
+    Arguments:
+        sheet_xml (str): the XML of the sheet, with a marker in each slot cell.
+        slots (tuple): the coordinates of the slot cells.
+
+    Returns:
+        tuple: containing the XML fragments around the slots and the coordinate and style attribute of each slot.
+    """
+
+    fragments = []
+    cells = []
+    position = 0
+    for match in re.finditer(r'<c r="(%s)"([^>]*?)(?:/>|>.*?</c>)' % '|'.join(slots), sheet_xml):
+        style = re.search(r' s="\d+"', match.group(2))
+        fragments.append(sheet_xml[position:match.start()])
+        cells.append((match.group(1), style.group(0) if style else ''))
+        position = match.end()
+
+    fragments.append(sheet_xml[position:])
+
+    if sorted(cell for cell, _ in cells) != sorted(slots):
+        raise ValueError(f'The prepared sheet does not have every slot: {cells}')
+
+    return fragments, cells
+
+
+@lru_cache(maxsize=None)
+def get_template_parts(template: str, on_premises: bool = on_premises) -> dict:
+    """
+    Prepares (only once per template) the raw parts of the label package: the template gets the layout of the first
+    page and of the following pages (which have their own copy of the logo), exactly as "make_label" sets them, and
+    a marker in each slot cell.
+
+    Arguments:
+        template (str): the template number.
+        on_premises (bool, optional): if True, uses the on-premises column widths (see "make_label").
+
+    Returns:
+        dict: a dictionary containing the parts of the package and the sheets split at their slots.
+    """
+
+    from openpyxl import load_workbook
+    from openpyxl.drawing.image import Image
+
+    from label_generator import get_template_bytes, set_label_layout
+
+    slots = get_slots(template)
+    wb = load_workbook(io.BytesIO(get_template_bytes(template)))
+    ws = wb.worksheets[0]
+    defaults = {cell: ws[cell].value for cell in slots}  # For the cells a label leaves as they are
+
+    for i in range(2):  # The first page and a following page
+        if i != 0:
+            wb.copy_worksheet(ws)
+
+        ws = wb.worksheets[i]
+        set_label_layout(ws, on_premises)
+
+        if i != 0:
+            ws.add_image(Image('logo_for_xlsx.png'), 'E1')
+
+        for cell in slots:
+            ws[cell] = f'@@{cell}@@'
+
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    with zipfile.ZipFile(buffer) as package:
+        parts = {name: package.read(name) for name in package.namelist()}
+
+    if b'/xl/drawings/drawing2.xml' not in parts['xl/worksheets/_rels/sheet2.xml.rels']:
+        raise ValueError('The following pages of the template are expected to use "drawing2.xml".')
+
+    workbook = parts['xl/workbook.xml'].decode()
+    title = re.search(r'<sheet [^>]*name="([^"]*)"', workbook).group(1)
+    print_area = re.search(r'<definedName name="_xlnm.Print_Area" localSheetId="0">[^<]*!([^<]*)</definedName>',
+                           workbook).group(1)
+    other_rels = re.findall(r'<Relationship Type="(?!%s")[^>]*/>' % re.escape(worksheet_rel),
+                            parts['xl/_rels/workbook.xml.rels'].decode())
+    content_types = re.sub(r'<Override PartName="/xl/(worksheets/sheet|drawings/drawing)\d+\.xml"[^>]*/>', '',
+                           parts['[Content_Types].xml'].decode())
+
+    return {
+        'static': {name: data for name, data in parts.items() if not page_parts.fullmatch(name) and name not in (
+            'xl/worksheets/sheet1.xml', 'xl/workbook.xml', 'xl/_rels/workbook.xml.rels', '[Content_Types].xml')},
+        'first_sheet': split_sheet(parts['xl/worksheets/sheet1.xml'].decode(), slots),
+        'next_sheet': split_sheet(parts['xl/worksheets/sheet2.xml'].decode(), slots),
+        'next_sheet_rels': parts['xl/worksheets/_rels/sheet2.xml.rels'].decode(),
+        'next_drawing': parts['xl/drawings/drawing2.xml'],
+        'next_drawing_rels': parts['xl/drawings/_rels/drawing2.xml.rels'],
+        'workbook': workbook,
+        'title': title,
+        'print_area': print_area,
+        'other_rels': [re.sub(r' Id="[^"]*"', '', rel) for rel in other_rels],
+        'content_types': content_types,
+        'defaults': defaults,
+        'slots': frozenset(slots),
+    }
+
+
+def quote_title(title: str) -> str:
+    """
+    Quotes a sheet title for a reference (e.g. 'Sheet1'!$A$1), as Excel does.
+
+    Arguments:
+        title (str): the sheet title.
+
+    Returns:
+        str: the quoted title.
+    """
+
+    return "'" + title.replace("'", "''") + "'"
+
+
+def get_cell_xml(coordinate: str, style: str, value: object) -> str:
+    """
+    Writes the XML of a cell, the same way openpyxl does (strings are written inline).
+
+    Arguments:
+        coordinate (str): the cell coordinate (e.g. 'C5').
+        style (str): the style attribute of the cell (e.g. ' s="39"'), or an empty string.
+        value (object): the cell value.
+
+    Returns:
+        str: the XML of the cell.
+    """
+
+    cell = Cell(None, value=value)  # Same data types (and checks for illegal characters) as openpyxl
+    value = cell._value
+    data_type = cell.data_type
+
+    if data_type == 'd':
+        raise TypeError(f'Dates are not supported by the XML fill engine (cell {coordinate}).')
+
+    attributes = f'r="{coordinate}"{style}' + {'s': ' t="inlineStr"', 'f': ''}.get(data_type, f' t="{data_type}"')
+
+    if value is None or value == '':
+        return f'<c {attributes}/>'
+    elif data_type == 'f':
+        return f'<c {attributes}><f>{escape(value[1:])}</f><v/></c>'
+    elif data_type == 's':
+        space = ' xml:space="preserve"' if value.strip() and value != value.strip() else ''
+        return f'<c {attributes}><is><t{space}>{escape(value)}</t></is></c>'
+
+    return f'<c {attributes}><v>{escape(safe_string(value))}</v></c>'
+
+
+def fill_sheet(sheet: tuple, label_cells: dict, defaults: dict) -> bytes:
+    """
+    Writes the label values into the slots of a sheet.
+
+    Arguments:
+        sheet (tuple): the sheet split at its slots (see "split_sheet").
+        label_cells (dict): the cell values of the page (see "get_label_cells").
+        defaults (dict): the template values of the slot cells, for the cells the label leaves as they are.
+
+    Returns:
+        bytes: the XML of the sheet.
+    """
+
+    fragments, cells = sheet
+    xml = [fragments[0]]
+    for (coordinate, style), fragment in zip(cells, fragments[1:]):
+        value = label_cells[coordinate] if coordinate in label_cells else defaults[coordinate]
+        xml += [get_cell_xml(coordinate, style, value), fragment]
+
+    return ''.join(xml).encode()
+
+
+def fill_workbook(template: str, label_pages: list, on_premises: bool = on_premises) -> bytes:
+    """
+    Builds the label workbook (.xlsx), with one sheet per page, from the prepared template parts.
+
+    Arguments:
+        template (str): the template number.
+        label_pages (list): the cell values of each page (see "get_label_pages").
+        on_premises (bool, optional): if True, uses the on-premises column widths (see "make_label").
+
+    Returns:
+        bytes: the content of the Excel file.
+    """
+
+    parts = get_template_parts(template, on_premises)
+
+    if not label_pages:
+        raise ValueError('A label must have at least one page.')
+
+    for label_cells in label_pages:
+        if not parts['slots'].issuperset(label_cells):
+            raise ValueError(f'Cells without a slot in the template: {set(label_cells) - parts["slots"]}')
+
+    pages = len(label_pages)
+    titles = [parts['title']] + [f'{parts["title"]} {k + 1}' for k in range(1, pages)]
+
+    sheets = ''.join(
+        f'<sheet xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships" '
+        f'name="{escape(title)}" sheetId="{k + 1}" state="visible" r:id="rId{k + 1}"/>' for k, title in enumerate(titles))
+    print_areas = ''.join(
+        f'<definedName name="_xlnm.Print_Area" localSheetId="{k}">'
+        f'{escape(quote_title(title))}!{parts["print_area"]}</definedName>' for k, title in enumerate(titles))
+    workbook = re.sub(r'<sheets>.*</sheets>', lambda _: f'<sheets>{sheets}</sheets>', parts['workbook'])
+    workbook = re.sub(r'<definedNames>.*</definedNames>', lambda _: f'<definedNames>{print_areas}</definedNames>',
+                      workbook)
+
+    workbook_rels = ''.join(
+        f'<Relationship Type="{worksheet_rel}" Target="/xl/worksheets/sheet{k + 1}.xml" Id="rId{k + 1}"/>'
+        for k in range(pages)) + ''.join(
+        rel.replace('/>', f' Id="rId{pages + j + 1}"/>') for j, rel in enumerate(parts['other_rels']))
+
+    content_types = parts['content_types'].replace('</Types>', ''.join(
+        f'<Override PartName="/xl/worksheets/sheet{k + 1}.xml" ContentType="{worksheet_type}"/>'
+        f'<Override PartName="/xl/drawings/drawing{k + 1}.xml" ContentType="{drawing_type}"/>'
+        for k in range(pages)) + '</Types>')
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as package:
+        package.writestr('[Content_Types].xml', content_types)
+        package.writestr('xl/workbook.xml', workbook)
+        package.writestr(
+            'xl/_rels/workbook.xml.rels',
+            f'<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">{workbook_rels}'
+            f'</Relationships>'
+        )
+
+        for name, data in parts['static'].items():
+            package.writestr(name, data, zipfile.ZIP_STORED if name.startswith('xl/media/') else zipfile.ZIP_DEFLATED)
+
+        package.writestr('xl/worksheets/sheet1.xml', fill_sheet(parts['first_sheet'], label_pages[0], parts['defaults']))
+        for k in range(1, pages):
+            package.writestr(f'xl/worksheets/sheet{k + 1}.xml',
+                             fill_sheet(parts['next_sheet'], label_pages[k], parts['defaults']))
+            package.writestr(f'xl/worksheets/_rels/sheet{k + 1}.xml.rels',
+                             parts['next_sheet_rels'].replace('/xl/drawings/drawing2.xml',
+                                                              f'/xl/drawings/drawing{k + 1}.xml'))
+            package.writestr(f'xl/drawings/drawing{k + 1}.xml', parts['next_drawing'])
+            package.writestr(f'xl/drawings/_rels/drawing{k + 1}.xml.rels', parts['next_drawing_rels'])
+
+    return buffer.getvalue()
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import tracemalloc
+
+    import pandas as pd
+    from openpyxl import load_workbook
+
+    from label_generator import get_label_pages, get_template_bytes, make_label
+
+    order_series = pd.Series({
+        'CustomerRef': {'value': '1', 'name': 'Parity Check Inc. & Co. <Test>'},
+        'ShipAddr': {'Line1': '123 Anywhere Street', 'Line2': 'Unit 9', 'City': 'Winnipeg',
+                     'CountrySubDivisionCode': 'MB', 'PostalCode': 'R0R 0R0'},
+    })
+
+    def get_inputs(template: str, pages: int) -> tuple:
+        checked = 1 if template == '' else 3
+        return (template, order_series, [f'Product {n} - 24 x 36 in.' for n in range(pages)], 1025, ' Rush ', 'box',
+                pages, [n + 1 for n in range(pages * checked)], [], '', None, 'Attn.: John Doe')
+
+    def render_openpyxl(template: str, pages: int) -> bytes:
+        template_, order_series_, *inputs = get_inputs(template, pages)
+        wb = load_workbook(io.BytesIO(get_template_bytes(template)))
+        wb = make_label(template_, order_series_, inputs[0], wb, *inputs[1:])[0]
+        buffer = io.BytesIO()
+        wb.save(buffer)
+        return buffer.getvalue()
+
+    def render_xml(template: str, pages: int) -> bytes:
+        return fill_workbook(template, get_label_pages(*get_inputs(template, pages))[0])
+
+    def describe(content: bytes) -> list:
+        wb = load_workbook(io.BytesIO(content))
+        return [(
+            [(cell.coordinate, cell.value, repr(cell.font), repr(cell.alignment), repr(cell.border), repr(cell.fill),
+              cell.number_format) for row in ws.iter_rows() for cell in row],
+            sorted(str(merged) for merged in ws.merged_cells.ranges),
+            {key: dimension.width for key, dimension in ws.column_dimensions.items()},
+            {key: dimension.height for key, dimension in ws.row_dimensions.items()},
+            str(ws.print_area).split('!')[-1],
+            (ws.page_setup.orientation, ws.page_setup.paperHeight, ws.page_setup.paperWidth, ws.page_margins.left,
+             ws.page_margins.top, ws.sheet_properties.pageSetUpPr.fitToPage),
+            [(image.anchor._from.col, image.anchor._from.row) for image in ws._images],
+        ) for ws in wb.worksheets]
+
+    print('Parity with openpyxl:')
+    mismatches = 0
+    for template in ('', '2'):
+        for pages in (1, 2, 5):
+            same = describe(render_openpyxl(template, pages)) == describe(render_xml(template, pages))
+            mismatches += not same
+            print(f'    template{template or "1"}, {pages} page(s): {"OK" if same else "DIFFERENT"}')
+
+    if mismatches:
+        sys.exit(f'{mismatches} workbook(s) differ from the openpyxl ones!')  # Exit status 1
+
+    print('Benchmark (ms per label, peak allocated MB):')
+    for pages in (1, 10, 40):
+        results = []
+        for render in (render_openpyxl, render_xml):
+            render('', pages)  # Warm-up (caches and the prepared template)
+            tracemalloc.start()
+            start = time.perf_counter()
+            for _ in range(5):
+                render('', pages)
+            seconds = (time.perf_counter() - start) / 5
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results.append((seconds * 1000, peak / 2 ** 20))
+
+        print(f'    {pages} page(s): openpyxl {results[0][0]:.1f} ms, {results[0][1]:.1f} MB; '
+              f'XML {results[1][0]:.1f} ms, {results[1][1]:.1f} MB ({results[0][0] / results[1][0]:.1f}x faster)')